@@ -1,86 +1,143 @@
 import re
 import os
+import json
 import time
 import zlib
+import hashlib
 import struct
 import threading
+import traceback
+import multiprocessing
 from functools import partial
+from operator import itemgetter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import sublime
 import sublime_plugin
 
 from .settings import Settings, SettingTogglerCommandMixin
 from .colorizer import SchemaColorizer
+from .palette import Palette, layer_colors
+from .cache import ManifestCache, MatchCache, LRUCache
+from .matcher import WORD_CHARS, create_matcher, scan_chunks
+from .state import ViewRegistry
+from .indexer import ProjectIndex
+from .stats import Probe
+from .debounce import DebounceController, BURST_GAP, MOVEMENT_DELAY
+from .scheduler import Scheduler, TimeSlice, CancelToken, Preempted, Cancelled, ACTIVE, VISIBLE, BACKGROUND
+from .regions import IntervalSet, RegionIndex, add_dirty, merge_spans, intersect_spans, index_data, data_size, replace_within, group_by_name
 
 # if $$highlighter$$ is colored in this comment
 # then no colors have been configured
 
 NAME = "Custom Highlighter"
 
-regex_cache = None
-re_cache = None
+palette_cache = None
+LAYERED_PALETTES = LRUCache()  # Palettes with project or syntax layers, by their layers
+COMPILED_MATCHERS = LRUCache()  # Matchers by the digest of the keys of their palettes
 
 fallback_colors = {
     "$$highlighter$$": "#ffd700", # fallback placeholder
 }
 
-def regex_factory():
-    global regex_cache
+def palette_factory():
+    global palette_cache
 
-    if regex_cache != None:
-        colors_regex, colors_regex_capture = regex_cache
-    else:
-        colors = settings.get('colors', {})
+    if palette_cache is None:
+        colors = settings.get('colors') or {}
+        families = settings.get('color_families') or ()
 
-        if not colors:
+        if not colors and not families:
             colors = fallback_colors
 
-        # print({
-        #     "colors": colors,
-        # })
+        palette_cache = Palette(colors, prefix=colorizer.prefix, icon_factory=toicon, families=families)
+        palette_cache.report()
+        colorizer.palette = palette_cache
 
-        colors_regex = r'(%s)' % r'(?<![-.\w])%s(?![-.\w])' % r'(?![-.\w])|(?<![-.\w])'.join(map(lambda key: re.escape(key), colors.keys()))
+    return palette_cache
 
-        # print({
-        #     "colors_regex": colors_regex,
-        # })
 
-        # colors_regex = []
+def matcher_factory(palette=None):
+    '''The matcher of palette (the global one by default), shared by all the palettes with the same keys'''
+    if palette is None:
+        palette = palette_factory()
 
-        # if simple_colors:
-            # colors_regex = r'(%s)' % colors_regex
+    digest = palette.digest()
+    matcher = COMPILED_MATCHERS.get(digest)
+    if matcher is None:
+        matcher = create_matcher(palette.names, settings.get('matcher'), palette.families)
+        COMPILED_MATCHERS.put(digest, matcher)
 
-        # colors_regex = r'|'.join(colors_regex)
+    return matcher
 
-        colors_regex_capture = r'\1'
 
-        # if len(colors_regex):
-        #     colors_regex_capture = r'|\1'
-        # else:
-            # colors_regex_capture = ''
+def syntax_name(view):
+    if hasattr(view, 'syntax'):
+        syntax = view.syntax()
+        if syntax is not None:
+            return syntax.name
+    return os.path.splitext(os.path.basename(view.settings().get('syntax') or ''))[0]
 
-        regex_cache = colors_regex, colors_regex_capture
 
-    # print({
-    #     "regex_cache": regex_cache,
-    # })
+def palette_layers(view):
+    '''The layers over the global palette for view: its project's, then its syntax's'''
+    project = view.settings().get('custom_highlighter') or {}
+    syntax = syntax_name(view)
+    layers = (
+        project,
+        (settings.get('syntaxes') or {}).get(syntax),
+        (project.get('syntaxes') or {}).get(syntax),
+    )
+    return [layer for layer in layers if layer]
 
-    return colors_regex, colors_regex_capture
 
+def view_palette(view, state=None):
+    '''Return the Palette and the matcher to highlight view with, kept in state until its settings change'''
+    if state is None:
+        return layered_palette(palette_layers(view))
 
-def re_factory():
-    global re_cache
+    changes = state.settings_changes
+    if state.palette is not None and state.palette[0] == changes:
+        return state.palette[1]
 
-    if re_cache != None:
-        colors_re, colors_re_capture = re_cache
-    else:
-        colors_regex, colors_regex_capture = regex_factory()
-        colors_re = re.compile(colors_regex)
-        colors_re_capture = re.sub(r'\\([0-9])', lambda m: chr(int(m.group(1))), colors_regex_capture)
+    # Project and syntax changes reach the layers through the settings of the view
+    view_settings = view.settings()
+    view_settings.clear_on_change(NAME)
+    view_settings.add_on_change(NAME, partial(view_settings_changed, state))
+    result = layered_palette(palette_layers(view))
+    state.palette = (changes, result)
+    return result
 
-        re_cache = colors_re, colors_re_capture
 
-    return colors_re, colors_re_capture
+def view_settings_changed(state):
+    state.settings_changes += 1
+
+
+def project_palette(window):
+    '''Return the Palette and the matcher of the project of window, without syntax layers'''
+    project = ((window.project_data() or {}).get('settings') or {}).get('custom_highlighter')
+    return layered_palette([project] if project else [])
+
+
+def layered_palette(layers):
+    '''Return the global Palette with layers over it (cached), and its matcher'''
+    if not layers:
+        palette = palette_factory()
+        return palette, matcher_factory(palette)
+
+    key = json.dumps(layers, sort_keys=True)
+    palette = LAYERED_PALETTES.get(key)
+    if palette is None:
+        base = {'colors': settings.get('colors'), 'color_families': settings.get('color_families')}
+        colors, families = layer_colors([base] + layers)
+        if not colors and not families:
+            colors = fallback_colors
+        palette = Palette(colors, prefix=colorizer.prefix, icon_factory=toicon, families=families)
+        palette.report(known=palette_factory().invalid)
+        LAYERED_PALETTES.put(key, palette)
+
+    return palette, matcher_factory(palette)
 
 
 # Full PNG is: PNG_HEAD + PNG_IHDR + PNG_IDAT[mode] + PNG_IEND
@@ -102,59 +159,126 @@ PNG_DATA = {
 DEFAULT_GUTTER_ICON = 'circle'
 
 
-def toicon(name, gutter_icon=True, light=True):
-    base_path = os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME)
+ICONS = {}  # Relative paths of the icons already written, {(name, gutter_icon, light): path}
 
-    if not os.path.exists(base_path):
-        os.mkdir(base_path)
+icon_cache_cache = None
 
-    if gutter_icon not in PNG_DATA:
-        gutter_icon = DEFAULT_GUTTER_ICON
 
-    icon_path = os.path.join(base_path, name + '_' + gutter_icon + '.png')
-
-    if not os.path.exists(icon_path):
-        r = int(name[4:6], 16)
-        g = int(name[6:8], 16)
-        b = int(name[8:10], 16)
-        a = int(name[10:12] or 'ff', 16) / 255.0
-        # print("r={} g={} b={} a={}".format(r, g, b, a))
-        if light:
-            x = 0xff * (1 - a)
-            y = 0xcc * (1 - a)
-        else:
-            x = 0x99 * (1 - a)
-            y = 0x66 * (1 - a)
+def icon_cache():
+    global icon_cache_cache
 
-        r *= a
-        g *= a
-        b *= a
+    if icon_cache_cache is None:
+        icon_cache_cache = ManifestCache(os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME))
 
-        # print("x(r={} g={} b={}), y(r={} g={} b={})".format(int(r + x), int(g + x), int(b + x), int(r + y), int(g + y), int(b + y)))
-        I1 = lambda v: struct.pack("!B", v & (2**8 - 1))
-        I4 = lambda v: struct.pack("!I", v & (2**32 - 1))
+    return icon_cache_cache
 
-        png = PNG_HEAD + PNG_IHDR
-        col_map = {
-            b'\x1f\x2f\x3f': I1(int(r + x)) + I1(int(g + x)) + I1(int(b + x)),
-            b'\x4f\x5f\x6f': I1(int(r + y)) + I1(int(g + y)) + I1(int(b + y)),
-        }
 
-        data = PNG_RE.sub(lambda m: col_map[m.group(0)], PNG_DATA[gutter_icon])
-        compressed = zlib.compress(data)
-        idat = b'IDAT' + compressed
-        png += I4(len(compressed)) + idat + I4(zlib.crc32(idat))
-        png += PNG_IEND
+match_cache_cache = None
+MATCH_CACHE_MIN_SIZE = 65536  # Smaller texts are scanned faster than their matches are read back
+REVALIDATE_DELAY = 1000  # Milliseconds from painting cached matches to scanning the text again
+
+
+def match_cache():
+    global match_cache_cache
+
+    if match_cache_cache is None:
+        match_cache_cache = MatchCache(os.path.join(sublime.cache_path(), NAME, 'matches'))
+
+    return match_cache_cache
+
+
+def icon_png(name, gutter_icon, light=True):
+    r = int(name[4:6], 16)
+    g = int(name[6:8], 16)
+    b = int(name[8:10], 16)
+    a = int(name[10:12] or 'ff', 16) / 255.0
+    # print("r={} g={} b={} a={}".format(r, g, b, a))
+    if light:
+        x = 0xff * (1 - a)
+        y = 0xcc * (1 - a)
+    else:
+        x = 0x99 * (1 - a)
+        y = 0x66 * (1 - a)
+
+    r *= a
+    g *= a
+    b *= a
 
-        with open(icon_path, 'wb') as fp:
+    # print("x(r={} g={} b={}), y(r={} g={} b={})".format(int(r + x), int(g + x), int(b + x), int(r + y), int(g + y), int(b + y)))
+    I1 = lambda v: struct.pack("!B", v & (2**8 - 1))
+    I4 = lambda v: struct.pack("!I", v & (2**32 - 1))
+
+    png = PNG_HEAD + PNG_IHDR
+    col_map = {
+        b'\x1f\x2f\x3f': I1(int(r + x)) + I1(int(g + x)) + I1(int(b + x)),
+        b'\x4f\x5f\x6f': I1(int(r + y)) + I1(int(g + y)) + I1(int(b + y)),
+    }
+
+    data = PNG_RE.sub(lambda m: col_map[m.group(0)], PNG_DATA[gutter_icon])
+    compressed = zlib.compress(data)
+    idat = b'IDAT' + compressed
+    png += I4(len(compressed)) + idat + I4(zlib.crc32(idat))
+    png += PNG_IEND
+    return png
+
+
+def toicon(name, gutter_icon=True, light=True):
+    if gutter_icon not in PNG_DATA:
+        gutter_icon = DEFAULT_GUTTER_ICON
+
+    key = (name, gutter_icon, light)
+    try:
+        return ICONS[key]
+    except KeyError:
+        pass
+
+    icon_name = '%s_%s%s.png' % (name, gutter_icon, '' if light else '_dark')
+    cache = icon_cache()
+    base_path = cache.path
+    icon_path = cache.file_path(icon_name)
+
+    # Checked under the lock, so the file isn't evicted between the check and its use
+    with cache.lock:
+        exists = os.path.exists(icon_path)
+        if exists:
+            cache.touch(icon_name)
+
+    if not exists:
+        if not os.path.exists(base_path):
+            try:
+                os.mkdir(base_path)
+            except OSError:
+                pass  # created by another thread meanwhile
+
+        # Write aside and rename, icons may be generated from several threads at once
+        png = icon_png(name, gutter_icon, light)
+        tmp_path = '%s.%s.tmp' % (icon_path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as fp:
             fp.write(png)
+        os.replace(tmp_path, icon_path)
 
-    relative_icon_path = os.path.relpath(icon_path, os.path.dirname(sublime.packages_path()))
-    relative_icon_path = relative_icon_path.replace('\\', '/')
+        cache.add(icon_name, len(png))
+        cache.schedule(scan_executor())
 
+    # Resource paths are relative to the directory holding Packages/
+    relative_icon_path = 'Packages/User/%s.cache/%s' % (NAME, icon_name)
+
+    ICONS[key] = relative_icon_path
     return relative_icon_path
 
 
+def pregenerate_icons(palette):
+    '''Write the gutter icons of all the palette colors on the worker pool'''
+    gutter_icon = settings.get('gutter_icon', True)
+    if not gutter_icon:
+        return
+
+    executor = scan_executor()
+    for name in palette.colors:
+        if (name, gutter_icon if gutter_icon in PNG_DATA else DEFAULT_GUTTER_ICON, True) not in ICONS:
+            executor.submit(toicon, name, gutter_icon)
+
+
 # Commands
 
 class CustomHighlighterCommand(sublime_plugin.WindowCommand):
@@ -217,6 +341,195 @@ class CustomHighlighterRestoreCommand(sublime_plugin.TextCommand):
         colorizer.restore_color_scheme()
 
 
+PHASES = ('scheme_setup', 'scan', 'normalize', 'scheme_write', 'diff', 'icons', 'queue_wait', 'add_regions')
+
+
+def performance_report():
+    '''Return the profile summary of every view highlighted so far, busiest first'''
+    names = {}
+    for window in sublime.windows():
+        for view in window.views():
+            names[view.id()] = view.file_name() or view.name() or 'untitled'
+    now = time.time()
+    entries = []
+    for state in VIEWS:
+        if not state.profile.passes:
+            continue
+        entry = state.profile.summary()
+        entry.update(time=now, view=state.view_id, file=names.get(state.view_id, 'closed'))
+        entry['debounce'] = dict(state.decision._asdict()) if state.decision is not None else None
+        entries.append(entry)
+    entries.sort(key=lambda entry: -entry['passes'])
+    writes = colorizer.write_times
+    entries.append({
+        'time': now,
+        'view': None,
+        'file': '(scheme)',
+        'passes': writes.count,
+        'phases': {'overlay_write': {'p50': writes.percentile(50), 'p95': writes.percentile(95), 'max': writes.max()}} if writes.count else {},
+        'counts': {},
+        'hottest': [],
+        'debounce': None,
+    })
+    return entries
+
+
+def format_report(entries):
+    def ms(value):
+        return '%9.2f' % value if value is not None else '%9s' % '-'
+
+    lines = []
+    for entry in entries:
+        lines.append('%s (%d passes)' % (entry['file'], entry['passes']))
+        phases = entry['phases']
+        if phases:
+            lines.append('    %-14s %9s %9s %9s' % ('phase (ms)', 'p50', 'p95', 'max'))
+            for phase in sorted(phases, key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES)):
+                stat = phases[phase]
+                lines.append('    %-14s %s %s %s' % (phase, ms(stat['p50']), ms(stat['p95']), ms(stat['max'])))
+        counts = entry['counts']
+        if counts:
+            lines.append('    %-14s %9s %9s %9s' % ('per pass', 'p50', 'p95', 'max'))
+            for name in sorted(counts):
+                stat = counts[name]
+                lines.append('    %-14s %9d %9d %9d' % (name, stat['p50'], stat['p95'], stat['max']))
+        if entry['hottest']:
+            lines.append('    hottest: %s' % ', '.join('%s (%d)' % (key, n) for key, n in entry['hottest']))
+        decision = entry['debounce']
+        if decision:
+            lines.append('    debounce: %s/%s ms (latency %.1f ms, typing interval %s ms)' % (
+                decision['delay'], decision['delay_when_busy'], decision['latency'],
+                '-' if decision['cadence'] is None else '%.0f' % decision['cadence']))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+class CustomHighlighterPerformanceReportCommand(sublime_plugin.WindowCommand):
+    '''Show p50/p95/max per highlight phase, or append them to a JSON lines file when export is set'''
+
+    def run(self, export=False):
+        entries = performance_report()
+        if export:
+            path = os.path.join(sublime.packages_path(), 'User', '%s.performance.jsonl' % NAME)
+            with open(path, 'a') as fp:
+                for entry in entries:
+                    fp.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.window.open_file(path)
+            return
+
+        view = self.window.new_file()
+        view.set_name('%s Performance' % NAME)
+        view.set_scratch(True)
+        view.run_command('append', {'characters': format_report(entries)})
+        view.set_read_only(True)
+
+
+INDEXES = {}  # ProjectIndex by the folders indexed
+INDEX_PROGRESS_INTERVAL = 0.5  # Seconds between status bar updates while indexing
+INDEX_WORKERS = 4  # Threads reading files while others scan, for I/O overlap only
+__index_lock_ = threading.Lock()
+
+
+def project_index(folders):
+    '''Return the ProjectIndex of folders, loaded from disk the first time'''
+    key = '\n'.join(sorted(folders))
+    with __index_lock_:
+        index = INDEXES.get(key)
+        if index is None:
+            name = '%s.json' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+            index = INDEXES[key] = ProjectIndex(os.path.join(sublime.cache_path(), NAME, 'index', name))
+            index.load()
+    return index
+
+
+class CustomHighlighterIndexProjectCommand(sublime_plugin.WindowCommand):
+    '''Index where the palette keys are used in the project folders, query is "usages" or "unused" to query the index'''
+
+    def run(self, query=None):
+        folders = self.window.folders()
+        if not folders:
+            sublime.status_message('%s: No folders to index' % NAME)
+            return
+
+        palette, matcher = project_palette(self.window)
+        index = project_index(folders)
+        if query and index.digest == palette.digest():
+            self.show(index, palette, query)
+            return
+
+        with __index_lock_:
+            if index.indexing:
+                sublime.status_message('%s: Already indexing' % NAME)
+                return
+            index.indexing = True
+
+        preferences = sublime.load_settings('Preferences.sublime-settings')
+        walk = {
+            'folder_exclude_patterns': preferences.get('folder_exclude_patterns') or (),
+            'file_exclude_patterns': (preferences.get('file_exclude_patterns') or []) + (preferences.get('binary_file_patterns') or []),
+        }
+        thread = threading.Thread(target=self.index, args=(index, folders, palette, matcher, query, walk))
+        thread.daemon = True
+        thread.start()
+
+    def index(self, index, folders, palette, matcher, query, walk):
+        shown = [0]
+
+        def progress(done, total):
+            now = time.time()
+            if now - shown[0] > INDEX_PROGRESS_INTERVAL:
+                shown[0] = now
+                sublime.status_message('%s: Indexing %d/%d files' % (NAME, done, total))
+
+        # Own pool, so indexing does not hold back the icon and cache writes of highlighting.
+        # Threads run Python one at a time and the plugin host can't spawn processes, so the
+        # files are scanned one after the other whatever the cores, the pool only overlaps
+        # reading them
+        executor = ThreadPoolExecutor(max_workers=INDEX_WORKERS)
+        try:
+            scanned, removed = index.refresh(folders, matcher, palette.digest(), executor=executor, progress=progress, **walk)
+            index.save()
+        except Exception:
+            traceback.print_exc()
+            return
+        finally:
+            executor.shutdown(wait=False)
+            index.indexing = False
+
+        sublime.status_message('%s: Indexed %d files (%d scanned, %d gone), %d keys used' % (
+            NAME, len(index.files), scanned, removed, len(index.keys)))
+        if query:
+            sublime.set_timeout(partial(self.show, index, palette, query), 0)
+
+    def show(self, index, palette, query):
+        if query == 'usages':
+            counts = index.counts().most_common()
+            if not counts:
+                sublime.status_message('%s: No keys used in the project' % NAME)
+                return
+            items = [[key, '%d usages' % count] for key, count in counts]
+            self.window.show_quick_panel(items, lambda i: i >= 0 and self.show_usages(index, counts[i][0]))
+        elif query == 'unused':
+            unused = index.unused(palette.names)
+            if not unused:
+                sublime.status_message('%s: Every key of the palette is used' % NAME)
+                return
+            self.window.show_quick_panel([[key, palette.colors[palette.names[key]]] for key in unused], lambda i: None)
+
+    def show_usages(self, index, key):
+        usages = index.usages(key)
+        folders = self.window.folders()
+
+        def relative(path):
+            for folder in folders:
+                if path.startswith(folder + os.sep):
+                    return os.path.relpath(path, folder)
+            return path
+
+        items = [[key, '%s:%d:%d' % (relative(path), row, col)] for path, row, col in usages]
+        self.window.show_quick_panel(items, lambda i: i >= 0 and self.window.open_file('%s:%d:%d' % usages[i], sublime.ENCODED_POSITION))
+
+
 all_regs = []
 
 
@@ -258,7 +571,8 @@ class CustomHighlighterCommand(sublime_plugin.TextCommand):
     def reset(self):
         '''Removes existing lint marks and restores user settings.'''
         erase_highlight_colors()
-        TIMES.clear()
+        for state in VIEWS:
+            state.scan_time = None
         colorizer.setup_color_scheme(self.view.settings())
         queue_highlight_colors(self.view, preemptive=True)
 
@@ -292,28 +606,34 @@ class CustomHighlighterViewEventListener(sublime_plugin.ViewEventListener):
         if settings.get('highlight') is not True:
             return
 
+        record_edit(VIEWS.state(self.view))
+
+        if incremental_enabled():
+            return  # CustomHighlighterTextChangeListener queues the changed spans
+
+        state = VIEWS.get(self.view.id())
+        if state is not None and state.coverage is not None and not TRACK_CHANGES:
+            state.coverage.clear()  # offsets are unknown, refill the viewport
+
         action = self.view.command_history(0, True)[0]
         if action == 'revert':
             erase_highlight_colors()
             queue_highlight_colors(self.view, preemptive=True)
         else:
-            selection = action != 'paste'
-            queue_highlight_colors(self.view, preemptive=selection, selection=selection)
+            # Typing waits for the delay picked by DEBOUNCE like any other edit
+            queue_highlight_colors(self.view, selection=action != 'paste')
 
     def on_close(self):
-        vid = self.view.id()
-        if vid in TIMES:
-            del TIMES[vid]
-        if vid in CUSTOM_HIGHLIGHTS:
-            del CUSTOM_HIGHLIGHTS[vid]
+        SCANS.discard(self.view.id())
+        VIEWS.discard(self.view.id())
 
     def on_activated(self):
         if self.view.file_name() is None:
             return
-        vid = self.view.id()
-        if vid in TIMES:
+        state = VIEWS.state(self.view)
+        if state.scan_time is not None:
             return
-        TIMES[vid] = 100
+        state.scan_time = 100
 
         if settings.get('highlight') in (False, 'save-only'):
             return
@@ -327,203 +647,443 @@ class CustomHighlighterViewEventListener(sublime_plugin.ViewEventListener):
         queue_highlight_colors(self.view, preemptive=True)
 
     def on_selection_modified(self):
-        delay_queue(1000)  # on movement, delay queue (to make movement responsive)
+        # on movement, delay queue (to make movement responsive)
+        state = VIEWS.get(self.view.id())
+        delay_queue(DEBOUNCE.movement_delay(state.latency) if state is not None else MOVEMENT_DELAY)
+
+
+# Whether the edits are known (Sublime Text 4), so highlight offsets can follow them
+TRACK_CHANGES = hasattr(sublime_plugin, 'TextChangeListener')
+
+if TRACK_CHANGES:
+    class CustomHighlighterTextChangeListener(sublime_plugin.TextChangeListener):
+        @classmethod
+        def is_applicable(cls, buffer):
+            return True
+
+        def on_text_changed(self, changes):
+            # Offsets follow the edits in every mode, the passes merging with them rely on it
+            for state in VIEWS.for_buffer(self.buffer.id()):
+                record_changes(state, changes)
+
+            if settings.get('highlight') is not True or not incremental_enabled():
+                return
+
+            for view in self.buffer.views():
+                queue_highlight_colors(view, incremental=True)
+
+    def incremental_enabled():
+        return bool(settings.get('incremental', True))
+else:
+    def incremental_enabled():
+        return False
+
+
+# Files larger than this are scanned in chunks, checking for cancellation between them
+LARGE_FILE_SIZE = 512000
+
+scan_executor_cache = None
+
+
+def scan_executor():
+    global scan_executor_cache
+
+    if scan_executor_cache is None:
+        # Icons and cache files are written here. Worker processes can't be
+        # spawned from the plugin host and threads run Python one at a time,
+        # so the chunks of large files are scanned by the pass itself instead
+        scan_executor_cache = ThreadPoolExecutor(max_workers=multiprocessing.cpu_count())
+
+    return scan_executor_cache
+
+
+VIEWS = ViewRegistry()  # Highlight state of the views
+SCANS = Scheduler()  # Highlight passes waiting for the background thread, one per view
+APPLIES = Scheduler()  # Scan results waiting for the main thread
+
+# Incremental scans are widened by up to this many characters to reach a token boundary
+TOKEN_LIMIT = 256
+TOKEN_HEAD_RE = re.compile(r'%s*' % WORD_CHARS)
+TOKEN_TAIL_RE = re.compile(r'%s*\Z' % WORD_CHARS)
+
+
+def record_changes(state, changes):
+    '''Shift the highlighted regions of a view state by the edits and remember what was edited'''
+    if state.change_count is None:
+        return  # never highlighted, the next pass is a full one anyway
+
+    highlights = state.highlights
+    coverage = state.coverage
+    dirty = state.dirty or []
+    for change in changes:
+        a, b, length = change.a.pt, change.b.pt, len(change.str)
+        highlights.shift(a, b, length)
+        dirty = add_dirty(dirty, a, b, length)
+        if coverage is not None:
+            coverage.shift(a, b, length)
+            coverage.remove(a, a + length)
+    state.dirty = dirty
+
+
+def token_regions(view, spans, margin):
+    '''Widen the spans by margin and out to the surrounding token boundaries'''
+    size = view.size()
+    widened = []
+
+    for begin, end in spans:
+        begin = max(begin - margin, 0)
+        end = min(end + margin, size)
+        head = view.substr(sublime.Region(max(begin - TOKEN_LIMIT, 0), begin))
+        begin -= len(TOKEN_TAIL_RE.search(head).group())
+        tail = view.substr(sublime.Region(end, min(end + TOKEN_LIMIT, size)))
+        end += len(TOKEN_HEAD_RE.match(tail).group())
+        widened.append((begin, end))
+
+    return [sublime.Region(begin, end) for begin, end in merge_spans(widened)]
+
+
+def viewport_window(view):
+    '''The visible region plus the configured margin, as a (begin, end) span'''
+    visible = view.visible_region()
+    margin = int(settings.get('viewport_margin', 20000))
+    return max(visible.begin() - margin, 0), min(visible.end() + margin, view.size())
+
+
+def check_viewport(view):
+    '''Queue a fill pass if the viewport shows text that hasn't been scanned'''
+    state = VIEWS.get(view.id())
+
+    if state is None or state.coverage is None or time.time() < state.viewport_pending + 1:
+        return
 
+    if state.coverage.missing(*viewport_window(view)):
+        state.viewport_pending = time.time()
+        queue_highlight_colors(view, preemptive=True, viewport=True)
 
-TIMES = {}  # collects how long it took the color highlight to complete
-CUSTOM_HIGHLIGHTS = {}  # Highlighted regions
+
+VIEWPORT_POLL_INTERVAL = 250  # There's no scroll event, the active view is polled instead
+__viewport_polling_ = False
+
+
+def viewport_poll():
+    global __viewport_polling_
+
+    if not __viewport_polling_:
+        return
+
+    if not settings.get('lazy_highlight') or settings.get('highlight') is False:
+        __viewport_polling_ = False
+        return
+
+    view = sublime.active_window().active_view()
+    if view:
+        check_viewport(view)
+
+    sublime.set_timeout(viewport_poll, VIEWPORT_POLL_INTERVAL)
+
+
+def start_viewport_poll():
+    global __viewport_polling_
+
+    if settings.get('lazy_highlight') and not __viewport_polling_:
+        __viewport_polling_ = True
+        sublime.set_timeout(viewport_poll, VIEWPORT_POLL_INTERVAL)
+
+
+def live_data(view, index):
+    '''RegionIndex data of the regions of index where the view has them now'''
+    matches = [(r.begin(), r.end(), name) for name in index for r in view.get_regions(name) if not r.empty()]
+    matches.sort()
+    return index_data(matches)
 
 
 def erase_highlight_colors(view=None):
     if view:
-        vid = view.id()
-        if vid in CUSTOM_HIGHLIGHTS:
-            for name in CUSTOM_HIGHLIGHTS[vid]:
-                view.erase_regions(name)
-                view.erase_regions(name + '_icon')
-        CUSTOM_HIGHLIGHTS[vid] = set()
+        state = VIEWS.get(view.id())
+        if state is None:
+            return  # never highlighted
+        for name in state.highlights:
+            view.erase_regions(name)
+            view.erase_regions(name + '_icon')
+        state.highlights = RegionIndex()
+        state.coverage = None
     else:
         for window in sublime.windows():
             for view in window.views():
                 erase_highlight_colors(view)
 
 
-def highlight_colors(view, selection=False, **kwargs):
+def scope_selector():
+    '''The selector of the scopes to scan (the scopes setting), None to scan everything'''
+    scopes = settings.get('scopes')
+    if isinstance(scopes, (list, tuple)):
+        scopes = ', '.join(scopes)
+    return scopes or None
+
+
+def scoped_spans(view, selector, spans=None):
+    '''Sorted spans of the text in scopes matching selector, only within the sorted spans if given
+
+    Partial passes score the scopes of the tokens in their spans, rather
+    than having find_by_selector() go over the whole view (ST3 does not
+    have extract_tokens_with_scopes, so it still does).'''
+    if spans is None or not hasattr(view, 'extract_tokens_with_scopes'):
+        found = merge_spans((r.begin(), r.end()) for r in view.find_by_selector(selector))
+        return found if spans is None else intersect_spans(spans, found)
+
+    scores = {}
+    found = []
+    for begin, end in spans:
+        for region, scope in view.extract_tokens_with_scopes(sublime.Region(begin, end)):
+            score = scores.get(scope)
+            if score is None:
+                score = scores[scope] = sublime.score_selector(scope, selector)
+            if score > 0:
+                found.append((max(region.begin(), begin), min(region.end(), end)))
+    return merge_spans(found)
+
+
+def highlight_colors(view, selection=False, incremental=False, viewport=False, **kwargs):
+    '''Scan and highlight the view right away (main thread)'''
+    apply = scan_colors(view, selection=selection, incremental=incremental, viewport=viewport, **kwargs)
+    if apply:
+        apply()
+
+
+def scan_colors(view, selection=False, incremental=False, viewport=False, budget=None, revalidate=False, **kwargs):
+    '''Find and group the colors in the view, safe to call off the main thread.
+
+    Returns a callable that applies the result to the view on the main thread,
+    or None when there is nothing to do. Between lines and chunks, the scan
+    raises Cancelled if the view changed since it started, and checks the
+    TimeSlice budget, which may raise Preempted.
+
+    With the scopes setting, only the text in those scopes is scanned. Full
+    scans of large texts are looked up in the match cache first; a hit
+    is painted at once and the text scanned again later (revalidate), which
+    only applies its result if it differs from the cached one.'''
+    probe = Probe()
     view_settings = view.settings()
     colorizer.setup_color_scheme(view_settings)
+    probe.lap('scheme_setup')
 
-    vid = view.id()
+    state = VIEWS.state(view)
     start = time.time()
+    token = CancelToken(view.change_count)
+    change_count = token.expected
+
+    def check():
+        token.check()
+        if budget is not None:
+            budget.check()
+
+    palette, matcher = view_palette(view, state)
+
+    dirty = state.dirty
+    lazy = bool(settings.get('lazy_highlight'))
+    coverage = state.coverage
+
+    if state.change_count is None:
+        incremental = False
+
+    if coverage is None or not lazy:
+        viewport = False
 
     if len(view.sel()) > 100:
         selection = False
 
-    if selection:
+    # Partial passes merge their results with the regions highlighted before
+    merge = True
+    if incremental:
+        if not dirty:
+            return
+        selected_lines = token_regions(view, dirty, matcher.max_length)
+    elif viewport:
+        missing = coverage.missing(*viewport_window(view))
+        if not missing:
+            return
+        selected_lines = token_regions(view, missing, 0)
+    elif selection:
         selected_lines = [ln for r in view.sel() for ln in view.lines(r)]
-    elif view.size() > 512000:
+    elif lazy:
+        selected_lines = token_regions(view, [viewport_window(view)], 0)
+        merge = False
+    elif view.size() > LARGE_FILE_SIZE and not settings.get('large_files', True):
         selected_lines = view.lines(view.visible_region())
     else:
         selected_lines = None
+        merge = False
+
+    # Only the text in these scopes is scanned
+    selector = scope_selector()
 
-    words = {}
     found = []
+    text = None
     if selected_lines:
-        colors_re, colors_re_capture = re_factory()
-        matches = [colors_re.finditer(view.substr(l)) for l in selected_lines]
-        matches = [
-            (
-                sublime.Region(
-                    selected_lines[i].begin() + m.start(),
-                    selected_lines[i].begin() + m.end()
-                ),
-                m.groups()
-            ) if m else (None, None)
-            for i, am in enumerate(matches) for m in am
-        ]
-        matches = [
-            (
-                rg,
-                ''.join(
-                    gr[ord(g) - 1] or '' if ord(g) < 10 else g for g in colors_re_capture
-                )
-            )
-            for rg, gr in matches if rg
-        ]
-        if matches:
-            ranges, found = zip(*[q for q in matches if q])
+        # Lines of several cursors may overlap, scan each part of the text once
+        selected_lines = [sublime.Region(begin, end) for begin, end in merge_spans((r.begin(), r.end()) for r in selected_lines)]
+        spans = [(r.begin(), r.end()) for r in selected_lines]
+        if selector:
+            spans = scoped_spans(view, selector, spans)
+        size = view.size()
+        for span_begin, span_end in spans:
+            check()
+            probe.count('bytes', span_end - span_begin)
+            # Include one character of context on each side for the word boundaries
+            begin = max(span_begin - 1, 0)
+            line_text = view.substr(sublime.Region(begin, min(span_end + 1, size)))
+            for a, b, key in matcher.finditer(line_text, span_begin - begin, span_end - begin):
+                found.append((begin + a, begin + b, key))
+    elif selector:
+        scoped = scoped_spans(view, selector)
+        text = view.substr(sublime.Region(0, view.size()))
+        probe.count('bytes', sum(end - begin for begin, end in scoped))
+        for begin, end in scoped:
+            check()
+            found.extend(matcher.finditer(text, begin, end))
+    else:
+        text = view.substr(sublime.Region(0, view.size()))
+        probe.count('bytes', len(text))
+        digest = None
+        cached = None
+        if len(text) >= MATCH_CACHE_MIN_SIZE and settings.get('match_cache') is not False:
+            digest = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+            cached = match_cache().get(digest, palette.digest())
+        if cached is not None and not revalidate:
+            found = cached
+            probe.count('cache_hits', 1)
+            sublime.set_timeout(partial(queue_highlight_colors, view, revalidate=True), REVALIDATE_DELAY)
         else:
-            ranges = []
+            if len(text) > LARGE_FILE_SIZE:
+                found = scan_chunks(matcher, text, check=check)
+            else:
+                found = matcher.findall(text)
+            if digest is not None and found != cached:
+                match_cache().put(digest, palette.digest(), found)
+                match_cache().schedule(scan_executor())
+            elif revalidate and cached is not None:
+                # The painted highlights were right, only the latency is news
+                state.latency.add((time.time() - start) * 1000)
+                return
+
+    if token.cancelled():
+        raise Cancelled()
+
+    probe.lap('scan')
+    probe.count('matches', len(found))
+    probe.keys = Counter(map(itemgetter(2), found))
+
+    # Fix case when color it's the same as background color:
+    bg_col = colorizer.get_background_col(view)
+    resolved = dict((key, palette.distinct(palette.get(key), bg_col)) for key in set(key for _, _, key in found))
+    matches = [(begin, end, resolved[key]) for begin, end, key in found]
+    probe.lap('normalize')
+    probe.count('colors', len(resolved))
+
+    for name in set(resolved.values()):
+        colorizer.add_color(palette.colors[name])
+
+    colorizer.update(view)
+    probe.lap('scheme_write')
+
+    base = state.highlights.data
+    if merge:
+        # Without the edits, the offsets in base were not moved with the text, the view's are right
+        current = base if TRACK_CHANGES else live_data(view, state.highlights)
+        data, affected = replace_within(current, [(r.begin(), r.end()) for r in selected_lines], matches)
+        words = group_by_name(data, affected)
     else:
-        colors_regex, colors_regex_capture = regex_factory()
-        # print({
-        #     "colors_regex_a": colors_regex,
-        #     "colors_regex_capture": colors_regex_capture,
-        # })
-        ranges = view.find_all(colors_regex, 0, colors_regex_capture, found)
+        data = index_data(matches)
+        words = group_by_name(data)
+    probe.lap('diff')
+    probe.count('regions', data_size(data))
+
+    gutter_icon = settings.get('gutter_icon', True)
 
-    # print({
-    #     'found': found,
-    # })
+    icons = {}
+    if gutter_icon:
+        icon_scope = '%sgutter' % colorizer.prefix
+        for name, w in words.items():
+            if text is not None:
+                lines = set(text.rfind('\n', 0, begin) + 1 for begin, end in w)
+            else:
+                lines = set(view.line(begin).a for begin, end in w)
+            icons[name] = ([sublime.Region(i, i) for i in lines], icon_scope, palette.icon(name, gutter_icon))
 
-    colors = settings.get('colors', {})
+    for name, w in words.items():
+        words[name] = [sublime.Region(begin, end) for begin, end in w]
+    probe.lap('icons')
 
-    if not colors:
-        colors = fallback_colors
+    partial_scan = selection or incremental or viewport
+    scanned = [(r.begin(), r.end()) for r in selected_lines] if lazy and selected_lines else None
+    elapsed = (time.time() - start) * 1000
 
-    # print({
-    #     "colors": colors,
-    # })
+    retry = partial(queue_highlight_colors, view, preemptive=True, selection=selection, incremental=incremental, viewport=viewport)
+    requeue = partial(requeue_dropped, view, selection=selection, incremental=incremental, viewport=viewport)
 
-    for i, col in enumerate(found):
-        # mode, _, col = col.partition('|')
-        # print(col)
-        # col = col.rstrip(',')
-        # print(col)
-        # col = col.split(',')
-        # print(mode, _, col)
+    return partial(apply_colors, view, state, change_count, base, data, words, icons, merge, partial_scan, scanned, elapsed, retry, requeue, probe)
 
-        try:
-            # In the form of: black, #FFFFFFFF
-            # col0 = col[0]
-            # col0 = all_names_to_hex.get(col0.lower(), col0.upper())
-
-            color = colors[col].upper()
-
-            # print({col: color})
-
-            if len(color) == 4: #abc
-                color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + 'FF'
-            elif len(color) == 5: #abcd
-                color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + color[4] * 2
-            elif len(color) == 7: #aabbcc
-                color += 'FF'
-
-            if re.match(r'^#[A-F0-9]{8}$', color) == None:
-                raise ValueError('Invalid color format "%s"' % color)
-        # except (ValueError, IndexError, KeyError) as e:
-        except (KeyError, ValueError) as e:
-            # print({
-            #     type(e): e,
-            # })
-            continue
 
-        # Fix case when color it's the same as background color:
-        if hasattr(view, 'style'):
-            bg_col = (view.style()['background'] + 'FF')[:9].upper()
-            if col == bg_col:
-                br = int(bg_col[1:3], 16)
-                bg = int(bg_col[3:5], 16)
-                bb = int(bg_col[5:7], 16)
-                ba = int(bg_col[7:9], 16)
-                br += -1 if br > 1 else 1
-                bg += -1 if bg > 1 else 1
-                bb += -1 if bb > 1 else 1
-                col = '#%02X%02X%02X%02X' % (br, bg, bb, ba)
+def apply_colors(view, state, change_count, base, data, words, icons, merged, partial_scan, scanned, elapsed, retry, requeue, probe):
+    '''Put the regions found by scan_colors() in the view (main thread)'''
+    probe.lap('queue_wait')
+    state.viewport_pending = 0
 
-        # print(colorizer)
+    if view.change_count() != change_count:
+        requeue()  # the text changed since the scan
+        return
 
-        name = colorizer.add_color(col, colors)
+    if merged and state.highlights.data is not base:
+        retry()  # another pass was applied since the scan started, merge again with its result
+        return
 
-        # print({
-        #     "name": name,
-        # })
-        if name not in words:
-            words[name] = [ranges[i]]
-        else:
-            words[name].append(ranges[i])
+    start = time.time()
 
-    colorizer.update(view)
+    state.dirty = None
 
-    if selected_lines:
-        if vid not in CUSTOM_HIGHLIGHTS:
-            CUSTOM_HIGHLIGHTS[vid] = set()
-        for name in CUSTOM_HIGHLIGHTS[vid]:
-            ranges = []
-            affected_line = False
-            for _range in view.get_regions(name):
-                _line_range = False
-                for _line in selected_lines:
-                    if _line.contains(_range):
-                        _line_range = True
-                        break
-                if _line_range:
-                    affected_line = True
-                else:
-                    ranges.append(_range)
-            if affected_line or name in words:
-                if name not in words:
-                    words[name] = ranges
-                else:
-                    words[name].extend(ranges)
-    else:
+    if not merged:
         erase_highlight_colors(view)
-    all_regs = CUSTOM_HIGHLIGHTS[vid]
+    index = state.highlights
+    index.data = data
+    state.change_count = change_count
+
+    if scanned is None:
+        state.coverage = None
+    else:
+        if state.coverage is None or not merged:
+            state.coverage = IntervalSet()
+        for begin, end in scanned:
+            state.coverage.add(begin, end)
 
     highlight_values = bool(settings.get('highlight_values', True))
-    gutter_icon = settings.get('gutter_icon', True)
 
     for name, w in words.items():
         # print(name, w)
         if highlight_values:
             view.add_regions(name, w, name, flags=sublime.PERSISTENT)
 
-        if gutter_icon:
-            wi = [sublime.Region(i, i) for i in set(view.line(r).a for r in w)]
-            view.add_regions(name + '_icon', wi, '%sgutter' % colorizer.prefix, icon=toicon(name, gutter_icon=gutter_icon), flags=sublime.PERSISTENT)
+        if name in icons:
+            wi, icon_scope, icon = icons[name]
+            view.add_regions(name + '_icon', wi, icon_scope, icon=icon, flags=sublime.PERSISTENT)
+
+        index.keys.add(name)
 
-        all_regs.add(name)
+    total = elapsed + (time.time() - start) * 1000
+    state.latency.add(total)
+    probe.lap('add_regions')
+    state.profile.record(probe)
 
-    if not selection:
-        TIMES[vid] = (time.time() - start) * 1000  # Keep how long it took to do a full color highlight
-        # print('highlight took %s' % TIMES[vid])
+    if not partial_scan:
+        state.scan_time = total  # Keep how long it took to do a full color highlight
+        # print('highlight took %s' % state.scan_time)
 
 
 ################################################################################
 # Queue connection
 
-QUEUE = {}  # views waiting to be processed by Color Highlight
+DEBOUNCE = DebounceController()
 
-# For snappier color highlighting, different delays are used for different color highlighting times:
+# Until a view has latency samples for DEBOUNCE, delays depend on its last full highlight time:
 # (color_highlighting_time, (delay, delay_when_busy))
 DELAYS = (
     (50, (50, 100)),
@@ -532,37 +1092,58 @@ DELAYS = (
     (400, (400, 1000)),
     (600, (600, 1500)),
     (800, (800, 2000)),
-    (1200, (1200, 1000)),
+    (1200, (1200, 2500)),
     (1600, (1600, 3000)),
 )
 
 
-def get_delay(t, view):
-    delays = 0
+def record_edit(state):
+    '''Sample the typing cadence of a view'''
+    now = time.time()
+    interval = (now - state.last_edit) * 1000
+    if interval < BURST_GAP:
+        state.cadence.add(interval)
+    state.last_edit = now
+
+
+def get_delay(view):
+    state = VIEWS.get(view.id())
+    decision = DEBOUNCE.decide(state.latency, state.cadence) if state is not None else None
+
+    if decision is not None:
+        state.decision = decision
+        delays = decision[:2]
+        if settings.get('log_debounce'):
+            print("%s: view %s delays %s/%s ms (latency %.1f ms, typing interval %s ms)" % (
+                NAME, view.id(), decision.delay, decision.delay_when_busy, decision.latency,
+                '-' if decision.cadence is None else '%.0f' % decision.cadence))
+    else:
+        t = state.scan_time if state is not None and state.scan_time is not None else 100
+        delays = 0
 
-    for _t, d in DELAYS:
-        if _t <= t:
-            delays = d
-        else:
-            break
+        for _t, d in DELAYS:
+            if _t <= t:
+                delays = d
+            else:
+                break
 
-    delays = delays or DELAYS[0][1]
+        delays = delays or DELAYS[0][1]
 
     # If the user specifies a delay greater than the built in delay,
     # figure they only want to see marks when idle.
-    min_delay = int(settings.get('delay', 0) * 1000)
+    min_delay = int((settings.get('delay') or 0) * 1000)
 
     return (min_delay, min_delay) if min_delay > delays[1] else delays
 
 
-def _update_view(view, filename, **kwargs):
+def _update_view(view, filename, budget=None, **kwargs):
     # It is possible that by the time the queue is run,
     # the original file is no longer being displayed in the view,
     # or the view may be gone. This happens especially when
     # viewing files temporarily by single-clicking on a filename
     # in the sidebar or when selecting a file through the choose file palette.
-    valid_view = False
-    view_id = view.id()
+    if not view.is_valid():
+        return
 
     if view.is_loading():
         return
@@ -570,16 +1151,24 @@ def _update_view(view, filename, **kwargs):
     if (view.file_name() or '').encode('utf-8') != filename:
         return
 
-    for window in sublime.windows():
-        for v in window.views():
-            if v.id() == view_id:
-                valid_view = True
-                break
+    try:
+        apply = scan_colors(view, budget=budget, **kwargs)
+    except Cancelled:
+        sublime.set_timeout(partial(requeue_dropped, view, **kwargs), 0)
+        raise
+    if apply:
+        queue_apply(apply, budget.priority if budget is not None else ACTIVE)
 
-    if not valid_view:
-        return
 
-    highlight_colors(view, **kwargs)
+def requeue_dropped(view, selection=False, incremental=False, viewport=False, **kwargs):
+    '''Queue a pass dropped as stale again, where edits queue none themselves (main thread)
+
+    Highlighting as you type, the edit that made the pass stale queued a
+    newer one. In the load-save and save-only modes nothing else would, so
+    the same kind of pass is queued again, unless the view has one pending.'''
+    if settings.get('highlight') is True or view.id() in SCANS or not view.is_valid():
+        return
+    queue_highlight_colors(view, selection=selection, incremental=incremental, viewport=viewport)
 
 
 def queue_highlight_colors(view, delay=-1, preemptive=False, **kwargs):
@@ -588,7 +1177,7 @@ def queue_highlight_colors(view, delay=-1, preemptive=False, **kwargs):
     if preemptive:
         delay = delay_when_busy = 0
     elif delay == -1:
-        delay, delay_when_busy = get_delay(TIMES.get(view.id(), 100), view)
+        delay, delay_when_busy = get_delay(view)
     else:
         delay_when_busy = delay
 
@@ -605,17 +1194,86 @@ def _callback(view, filename, kwargs):
     kwargs['callback'](view, filename, **kwargs)
 
 
+def view_priority(view):
+    '''ACTIVE for the view being edited, VISIBLE for views shown in some group, else BACKGROUND'''
+    window = view.window()
+    if window is None:
+        return BACKGROUND
+
+    vid = view.id()
+    active = window.active_view()
+    if active is not None and active.id() == vid:
+        return ACTIVE if window.id() == sublime.active_window().id() else VISIBLE
+
+    for group in range(window.num_groups()):
+        active = window.active_view_in_group(group)
+        if active is not None and active.id() == vid:
+            return VISIBLE
+
+    return BACKGROUND
+
+
 def background_custom_highlighter():
-    __lock_.acquire()
+    # Scans run here, most urgent first, each one hands its result over to the main thread.
+    # Only the jobs queued before the dispatch run, later ones wait for the signal of their delay
+    before = SCANS.mark()
+    while True:
+        job = SCANS.pop(before)
+        if job is None:
+            return
 
-    try:
-        callbacks = list(QUEUE.values())
-        QUEUE.clear()
-    finally:
-        __lock_.release()
+        try:
+            job.callback(budget=TimeSlice(SCANS, job.priority))
+        except Preempted:
+            # Put back in its place, unless a newer pass for the view was queued meanwhile. The
+            # more urgent job was queued since, so the rest waits for its dispatch; the scan
+            # starts over then
+            SCANS.push(job.key, job.priority, job.callback, replace=False, seq=job.seq)
+            return
+        except Cancelled:
+            pass  # the view changed, _update_view() saw to a newer pass
+        except Exception:
+            traceback.print_exc()
+
+
+APPLY_BUDGET = 0.01  # Seconds of applying per main thread tick, the rest waits for the next one
+__apply_lock_ = threading.Lock()
+__apply_scheduled_ = False
+
+
+def queue_apply(apply, priority):
+    '''Run apply on the main thread, in priority order'''
+    global __apply_scheduled_
+
+    APPLIES.push(None, priority, apply)
+
+    with __apply_lock_:
+        if __apply_scheduled_:
+            return
+        __apply_scheduled_ = True
+
+    sublime.set_timeout(run_applies, 0)
+
+
+def run_applies():
+    global __apply_scheduled_
+
+    start = time.time()
+    while time.time() - start < APPLY_BUDGET:
+        job = APPLIES.pop()
+        if job is None:
+            break
+        try:
+            job.callback()
+        except Exception:
+            traceback.print_exc()
 
-    for callback in callbacks:
-        sublime.set_timeout(callback, 0)
+    with __apply_lock_:
+        if not len(APPLIES):
+            __apply_scheduled_ = False
+            return
+
+    sublime.set_timeout(run_applies, 0)
 
 
 ################################################################################
@@ -630,14 +1288,15 @@ def queue_loop():
     '''An infinite loop running the color highlight in a background thread meant to
        update the view after user modifies it and then does no further
        modifications for some time as to not slow down the UI with color highlighting.'''
-    global __signaled_, __signaled_first_
+    global __signaled_, __signaled_first_, __dispatched_
 
     while __loop_:
         # print('acquire...')
         __semaphore_.acquire()
         __signaled_first_ = 0
         __signaled_ = 0
-        # print('DISPATCHING!', len(QUEUE))
+        __dispatched_ = time.time()
+        # print('DISPATCHING!', len(SCANS))
         queue_dispatcher()
 
 
@@ -647,7 +1306,7 @@ def queue(view, callback, kwargs):
     __lock_.acquire()
 
     try:
-        QUEUE[view.id()] = callback
+        SCANS.push(view.id(), view_priority(view), callback)
         delay = kwargs['delay']
 
         if now < __signaled_ + delay * 4:
@@ -667,8 +1326,8 @@ def _delay_queue(delay, preemptive):
     global __signaled_, __queued_
     now = time.time()
 
-    if not preemptive and now <= __queued_ + 0.01:
-        return  # never delay queues too fast (except preemptively)
+    if not preemptive and now <= __queued_ + 0.01 and __queued_ > __dispatched_:
+        return  # never delay queues too fast (except preemptively, or once the last signal went off)
 
     __queued_ = now
     _delay = float(delay) / 1000
@@ -708,6 +1367,7 @@ __semaphore_ = threading.Semaphore(0)
 __lock_ = threading.Lock()
 __queued_ = 0
 __signaled_ = 0
+__dispatched_ = 0
 __signaled_first_ = 0
 
 # First finalize old standing threads:
@@ -719,7 +1379,7 @@ def queue_finalize(timeout=None):
     global __pre_initialized_
 
     for thread in threading.enumerate():
-        if thread.isAlive() and thread.name == queue_thread_name:
+        if thread.is_alive() and thread.name == queue_thread_name:
             __pre_initialized_ = True
             thread.__semaphore_.release()
             thread.join(timeout)
@@ -739,10 +1399,41 @@ __active_custom_highlighter_thread.start()
 
 class CustomHighlighterSettings(Settings):
     def on_update(self):
+        global palette_cache
+        palette_cache = None
+        LAYERED_PALETTES.clear()
+        COMPILED_MATCHERS.clear()
+        for state in VIEWS:
+            view_settings_changed(state)
+        LAYERED_PALETTES.max_size = COMPILED_MATCHERS.max_size = self.get('matcher_cache_size') or 8
+        colorizer.invalidate()
+        palette = palette_factory()
+        pregenerate_icons(palette)
+        DEBOUNCE.busy_share = self.get('busy_share') or 0.2
+        # Rules of the colors no longer configured are dropped from the scheme
+        retained = list(palette.colors.values())
+        for layer in (self.get('syntaxes') or {}).values():
+            retained.extend(Palette(layer.get('colors') or {}, families=layer.get('color_families') or ()).colors.values())
+        colorizer.retain(retained)
+
+        cache = icon_cache()
+        cache.max_files = self.get('icon_cache_max_files') or 0
+        cache.max_size = (self.get('icon_cache_max_size') or 0) * 1024
+        cache.schedule(scan_executor())
+        cache = match_cache()
+        cache.max_files = self.get('match_cache_max_files') or 0
+        cache.max_size = (self.get('match_cache_max_size') or 0) * 1024
+        cache.schedule(scan_executor())
+        start_viewport_poll()
+
         window = sublime.active_window()
         view = window.active_view()
         view.run_command('custom_highlighter', dict(action='reset'))
 
+        if self.get('preseed_color_scheme'):
+            # Write the rules of all the colors now, so highlighting never has to
+            colorizer.preseed(palette.colors.values(), view)
+
 
 settings = CustomHighlighterSettings(NAME)
 
@@ -758,3 +1449,17 @@ if 'colorizer' not in globals():
 
 def plugin_loaded():
     settings.load()
+
+
+def plugin_unloaded():
+    global __viewport_polling_
+    __viewport_polling_ = False
+
+    if scan_executor_cache is not None:
+        scan_executor_cache.shutdown(wait=False)
+
+    if icon_cache_cache is not None:
+        icon_cache_cache.save()
+
+    if match_cache_cache is not None:
+        match_cache_cache.save()
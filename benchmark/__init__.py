@@ -0,0 +1,36 @@
+"""
+Headless benchmarks for Custom Highlighter.
+
+Run from the package directory with `python -m benchmark --help`. The
+plugin modules are imported as a package against the stand-in `sublime`
+and `sublime_plugin` modules found next to this file.
+
+"""
+import os
+import sys
+
+from cli import ROOT, load_module
+from . import sublime, sublime_plugin
+
+
+def load_plugin():
+    """Import CustomHighlighter.py headless and return the module."""
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+    # Like Sublime, start from the defaults shipped with the package
+    name = 'Custom Highlighter.sublime-settings'
+    with open(os.path.join(ROOT, name)) as f:
+        sublime.load_settings(name).update(sublime.decode_value(f.read()))
+
+    plugin = load_module('CustomHighlighter')
+    stop_plugin(plugin)
+    return plugin
+
+
+def stop_plugin(plugin):
+    """Stop the plugin's background queue thread so the process can exit."""
+    if getattr(plugin, '__loop_', False):
+        setattr(plugin, '__loop_', False)
+        getattr(plugin, '__semaphore_').release()
+        getattr(plugin, '__active_custom_highlighter_thread').join()
@@ -0,0 +1,225 @@
+"""
+Benchmark highlight_colors headless.
+
+    python -m benchmark --corpus tailwind css --sizes 1K 1M --palettes 10 20000
+    python -m benchmark --output after.json --compare before.json
+
+Times are in milliseconds (best of --repeat runs), peak memory in bytes.
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tracemalloc
+
+from . import load_plugin, sublime
+from . import corpora
+
+UNITS = {'K': 1024, 'M': 1024 * 1024}
+
+
+def parse_size(value):
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+class Timers(object):
+    """Accumulates the wall time spent in wrapped callables, per phase."""
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.totals[phase] = self.totals.get(phase, 0) + time.perf_counter() - start
+                self.counts[phase] = self.counts.get(phase, 0) + 1
+        return timed
+
+    def measure(self, phase, func, *args, **kwargs):
+        return self.wrap(phase, func)(*args, **kwargs)
+
+
+def reset(plugin):
+    """Forget everything the plugin wrote or cached, as on a fresh install."""
+    packages = sublime.packages_path()
+    shutil.rmtree(os.path.join(packages, 'User', '%s.cache' % plugin.NAME), ignore_errors=True)
+    shutil.rmtree(os.path.join(sublime.cache_path(), plugin.NAME), ignore_errors=True)
+    plugin.match_cache_cache = None
+    overlay = os.path.join(packages, 'User', 'Monokai.sublime-color-scheme')
+    if os.path.exists(overlay):
+        os.remove(overlay)
+    plugin.colorizer.clear()
+    plugin.colorizer.invalidate()
+    plugin.colorizer.need_update = False
+    plugin.colorizer.write_pending = False
+    plugin.VIEWS.clear()
+    plugin.ICONS.clear()
+
+
+def configure(plugin, colors, matcher):
+    plugin_settings = sublime.load_settings('%s.sublime-settings' % plugin.NAME)
+    plugin_settings.update({
+        'highlight': True,
+        'gutter_icon': 'circle',
+        'highlight_values': True,
+        'matcher': matcher,
+        'match_cache': False,  # highlight_warm measures a scan, not a cache read
+        'colors': colors,
+    })
+    plugin.settings.load(force=True)
+
+
+def run_once(plugin, window, text, colors, matcher, trace=False):
+    timers = Timers()
+    reset(plugin)
+    configure(plugin, colors, matcher)
+
+    plugin.palette_cache = None
+    plugin.COMPILED_MATCHERS.clear()
+    palette = timers.measure('normalize', plugin.palette_factory)
+    palette.icon_factory = timers.wrap('icons', palette.icon_factory)
+    matcher = timers.measure('compile', plugin.matcher_factory)
+
+    matches = timers.measure('scan', matcher.findall, text)
+
+    view = window.new_view(text, file_name='benchmark.txt')
+    view.add_regions = timers.wrap('region_apply', view.add_regions)
+    view.erase_regions = timers.wrap('region_apply', view.erase_regions)
+    plugin.colorizer.write = timers.wrap('scheme_write', plugin.colorizer.write)
+
+    peak = None
+    try:
+        if trace:
+            tracemalloc.start()
+        timers.measure('highlight', plugin.highlight_colors, view)
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        sublime.run_timeouts()
+
+        timers.measure('highlight_warm', plugin.highlight_colors, view)
+
+        # A keystroke costs moving the highlights (on the main thread) plus the pass
+        middle = view.size() // 2
+        key = next(iter(palette.names), '')
+        changes = view.replace_text(middle, middle, ' %s ' % key)
+        timers.measure('edit', plugin.record_changes, plugin.VIEWS.state(view), changes)
+        timers.measure('edit', plugin.highlight_colors, view, incremental=True)
+        sublime.run_timeouts()
+
+        # A new line at the start of a line changes no key
+        quarter = view.substr(sublime.Region(0, view.size() // 4)).rfind('\n') + 1
+        changes = view.replace_text(quarter, quarter, '\n')
+        timers.measure('edit_plain', plugin.record_changes, plugin.VIEWS.state(view), changes)
+        timers.measure('edit_plain', plugin.highlight_colors, view, incremental=True)
+        sublime.run_timeouts()
+    finally:
+        del plugin.colorizer.write
+        window.close_view(view)
+
+    regions = sum(len(view.get_regions(name)) for name in view.region_keys() if not name.endswith('_icon'))
+    counts = {
+        'matches': len(matches),
+        'distinct_colors': len(set(palette.names[key] for _, _, key in matches)),
+        'regions': regions,
+        'invalid': len(palette.invalid),
+    }
+    return timers.totals, counts, peak
+
+
+def run_case(plugin, window, corpus, size, palette_size, matcher, repeat):
+    colors = corpora.palette(palette_size)
+    text = corpora.document(corpus, size, colors)
+
+    best = {}
+    for _ in range(repeat):
+        totals, counts, _ = run_once(plugin, window, text, colors, matcher)
+        for phase, seconds in totals.items():
+            best[phase] = min(best.get(phase, seconds), seconds)
+    _, _, peak = run_once(plugin, window, text, colors, matcher, trace=True)
+
+    return {
+        'corpus': corpus,
+        'size': size,
+        'palette': palette_size,
+        'matcher': matcher,
+        'counts': counts,
+        'ms': dict((phase, round(seconds * 1000, 3)) for phase, seconds in sorted(best.items())),
+        'peak_memory': peak,
+    }
+
+
+def compare(results, baseline):
+    def case_key(case):
+        return (case['corpus'], case['size'], case['palette'], case['matcher'])
+
+    before = dict((case_key(case), case) for case in baseline['results'])
+    for case in results['results']:
+        old = before.get(case_key(case))
+        if not old:
+            continue
+        ratios = []
+        for phase, ms in sorted(case['ms'].items()):
+            old_ms = old['ms'].get(phase)
+            if old_ms:
+                ratios.append('%s %.2fx' % (phase, ms / old_ms))
+        sys.stderr.write('%s/%s/%s/%s: %s\n' % (case_key(case) + (', '.join(ratios),)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', nargs='+', default=sorted(corpora.CORPORA), choices=sorted(corpora.CORPORA))
+    parser.add_argument('--sizes', nargs='+', default=['1K', '100K', '1M'], help='document sizes (1K .. 50M)')
+    parser.add_argument('--palettes', nargs='+', type=int, default=[10, 1000, 20000], help='number of palette keys')
+    parser.add_argument('--matcher', nargs='+', default=['trie'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='previous JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    plugin = load_plugin()
+    window = sublime.active_window()
+    # on_update() runs commands in the active view, so there has to be one
+    window.new_view('', file_name='placeholder.txt')
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+    try:
+        for corpus in args.corpus:
+            for size in map(parse_size, args.sizes):
+                for palette_size in args.palettes:
+                    for matcher in args.matcher:
+                        case = run_case(plugin, window, corpus, size, palette_size, matcher, args.repeat)
+                        results['results'].append(case)
+                        sys.stderr.write('%(corpus)s %(size)s %(palette)s %(matcher)s %(ms)s\n' % case)
+    finally:
+        sublime.cleanup()
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Randomized check of the region bookkeeping in regions.py.
+
+    python -m benchmark.check_regions --trials 500 --seed 1
+
+RegionIndex.shift(), replace_within(), group_by_name(), add_dirty() and
+IntervalSet are checked against plain lists, with small blocks so edits
+fall across block boundaries. Then random edits are made to a stand-in
+view, each batch followed by an incremental pass, and the regions left
+in the view are compared with those a full scan of the edited text finds.
+The first difference is printed with the seed and trial that reproduce
+it, and the exit status is 1.
+
+"""
+import sys
+import random
+import argparse
+
+from cli import load_module
+from . import load_plugin, sublime
+from . import corpora
+
+regions = load_module('regions')
+
+
+class Mismatch(Exception):
+    pass
+
+
+def expect(condition, what, *details):
+    if not condition:
+        raise Mismatch(' '.join([what] + [repr(detail) for detail in details]))
+
+
+def flatten(data):
+    return [region for block in data for region in block]
+
+
+def random_regions(rnd, size, count):
+    points = sorted(rnd.sample(range(size), count * 2))
+    return [(points[i], points[i + 1], rnd.choice('abcdef')) for i in range(0, len(points), 2)]
+
+
+def random_edit(rnd, size):
+    a = rnd.randrange(size + 1)
+    b = min(size, a + rnd.randrange(10))
+    return a, b, rnd.randrange(10)
+
+
+def points(spans):
+    return set(pt for begin, end in spans for pt in range(begin, end))
+
+
+def check_index(rnd, size=400):
+    flat = random_regions(rnd, size, rnd.randrange(60))
+    index = regions.RegionIndex()
+    index.data = regions.index_data(flat)
+
+    for _ in range(rnd.randrange(1, 4)):
+        a, b, length = random_edit(rnd, size)
+        index.shift(a, b, length)
+        if b - a != length:  # same-length replacements are rescanned where they are
+            flat = [(regions.shift_point(begin, a, b, length), regions.shift_point(end, a, b, length), name) for begin, end, name in flat]
+        expect(flatten(index.data) == flat, 'shift', (a, b, length))
+    expect(len(index) == len(flat), 'len')
+
+    # Matches found in random spans, where no region outside the spans overlaps them
+    bounds = sorted(rnd.sample(range(size + 20), rnd.randrange(4) * 2))
+    spans = [(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2)]
+    kept = [r for r in flat if not any(begin <= r[0] and r[1] <= end for begin, end in spans)]
+    matches = []
+    for begin, end in spans:
+        pt = begin
+        while True:
+            stop = pt + rnd.randrange(1, 4)
+            if stop > end:
+                break
+            if rnd.random() < 0.5 and not any(r[0] < stop and pt < r[1] for r in kept):
+                matches.append((pt, stop, rnd.choice('abcxyz')))
+            pt = stop
+
+    data, affected = regions.replace_within(index.data, spans, matches)
+    found = flatten(data)
+    expected = sorted(kept + matches)
+    expect(sorted(found) == expected, 'replace_within', spans, matches)
+    expect([r[:2] for r in found] == [r[:2] for r in expected], 'replace_within order', spans)
+    expect(affected == set(name for _, _, name in set(flat).symmetric_difference(found)), 'affected', spans)
+    expect(all(len(block) for block in data), 'empty block')
+
+    for wanted in (None, set('ab'), set()):
+        groups = dict((name, []) for name in wanted or ())
+        for begin, end, name in found:
+            if wanted is None or name in wanted:
+                groups.setdefault(name, []).append((begin, end))
+        expect(regions.group_by_name(data, wanted) == groups, 'group_by_name', wanted)
+
+
+def check_dirty(rnd, size=400):
+    dirty = []
+    edited = []
+    for _ in range(rnd.randrange(1, 6)):
+        a, b, length = random_edit(rnd, size)
+        size += length - (b - a)
+        edited = [(regions.shift_point(begin, a, b, length), regions.shift_point(end, a, b, length)) for begin, end in edited]
+        edited.append((a, a + length))
+        dirty = regions.add_dirty(dirty, a, b, length)
+        expect(dirty == sorted(dirty), 'add_dirty order', dirty)
+        expect(points(edited) <= points(dirty), 'add_dirty coverage', dirty, edited)
+        expect(all(0 <= begin <= end <= size for begin, end in dirty), 'add_dirty bounds', dirty, size)
+
+
+def check_intervals(rnd, size=200):
+    intervals = regions.IntervalSet()
+    covered = set()
+    for _ in range(rnd.randrange(1, 20)):
+        begin = rnd.randrange(size)
+        end = begin + rnd.randrange(30)
+        op = rnd.choice(('add', 'remove', 'shift'))
+        if op == 'add':
+            intervals.add(begin, end)
+            covered |= set(range(begin, end))
+        elif op == 'remove':
+            intervals.remove(begin, end)
+            covered -= set(range(begin, end))
+        else:
+            a, b, length = random_edit(rnd, size)
+            before = list(intervals)
+            intervals.shift(a, b, length)
+            covered = points((regions.shift_point(begin, a, b, length), regions.shift_point(end, a, b, length)) for begin, end in before)
+        spans = list(intervals)
+        expect(points(spans) == covered, op, spans)
+        expect(all(a < b for a, b in spans) and all(spans[i][1] <= spans[i + 1][0] for i in range(len(spans) - 1)), op + ' disjoint', spans)
+        gaps = intervals.missing(0, size)
+        expect(points(gaps) == set(range(size)) - covered, 'missing', gaps)
+
+
+def view_regions(view):
+    return sorted((r.a, r.b, name) for name in view.region_keys() if not name.endswith('_icon') for r in view.get_regions(name))
+
+
+def check_passes(plugin, window, rnd, colors, text, edits):
+    view = window.new_view(text, file_name='check.html')
+    try:
+        plugin.highlight_colors(view)
+        sublime.run_timeouts()
+        keys = list(colors)
+        for trial in range(edits):
+            state = plugin.VIEWS.state(view)
+            for _ in range(rnd.randrange(1, 4)):
+                size = view.size()
+                a = rnd.randrange(size + 1)
+                kind = rnd.random()
+                if kind < 0.4:
+                    b, insert = a, rnd.choice(('', ' ')) + rnd.choice(keys) + rnd.choice(('', ' ', '\n'))
+                elif kind < 0.7:
+                    b, insert = min(size, a + rnd.randrange(1, 20)), ''
+                elif kind < 0.9:
+                    source = rnd.randrange(size + 1)
+                    b, insert = min(size, a + rnd.randrange(10)), view.substr(sublime.Region(source, min(size, source + rnd.randrange(30))))
+                else:
+                    b, insert = a, '\n'
+                plugin.record_changes(state, view.replace_text(a, b, insert))
+            plugin.highlight_colors(view, incremental=True)
+            sublime.run_timeouts()
+
+            reference = window.new_view(view.substr(sublime.Region(0, view.size())), file_name='reference.html')
+            try:
+                plugin.highlight_colors(reference)
+                sublime.run_timeouts()
+                expected = view_regions(reference)
+            finally:
+                window.close_view(reference)
+                plugin.VIEWS.discard(reference.id())
+            found = view_regions(view)
+            expect(found == expected, 'incremental pass at edit %d' % trial, sorted(set(found) ^ set(expected))[:10])
+            expect(flatten(state.highlights.data) == found, 'state highlights at edit %d' % trial)
+    finally:
+        window.close_view(view)
+        plugin.VIEWS.discard(view.id())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark.check_regions', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=500, help='random cases of each region helper')
+    parser.add_argument('--edits', type=int, default=200, help='edit batches made to the stand-in view')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--block-size', type=int, default=4, help='regions per block, small to cross block boundaries often')
+    args = parser.parse_args(argv)
+
+    regions.BLOCK_SIZE = args.block_size
+    rnd = random.Random(args.seed)
+    stage = 'regions'
+    trial = 0
+    try:
+        for check in (check_index, check_dirty, check_intervals):
+            stage = check.__name__
+            for trial in range(args.trials):
+                check(rnd)
+
+        stage = 'passes'
+        trial = 0
+        plugin = load_plugin()
+        window = sublime.active_window()
+        # on_update() runs commands in the active view, so there has to be one
+        window.new_view('', file_name='placeholder.txt')
+        colors = corpora.palette(300)
+        sublime.load_settings('%s.sublime-settings' % plugin.NAME).update({
+            'highlight': True,
+            'incremental': True,
+            'lazy_highlight': False,
+            'match_cache': False,
+            'colors': colors,
+        })
+        plugin.settings.load(force=True)
+        check_passes(plugin, window, rnd, colors, corpora.document('tailwind', 20000, colors), args.edits)
+    except Mismatch as e:
+        sys.stderr.write('%s, seed %d, trial %d: %s\n' % (stage, args.seed, trial, e))
+        return 1
+    finally:
+        sublime.cleanup()
+
+    sys.stderr.write('ok\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
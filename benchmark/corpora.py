@@ -0,0 +1,125 @@
+"""Synthetic palettes and documents for the benchmarks."""
+import random
+
+PREFIXES = (
+    'bg', 'text', 'border', 'ring', 'from', 'via', 'to', 'divide', 'outline',
+    'decoration', 'shadow', 'accent', 'caret', 'fill', 'stroke', 'placeholder',
+    'ring-offset',
+)
+VARIANTS = ('', 'hover:', 'focus:', 'dark:', 'md:')
+COLORS = (
+    'slate', 'gray', 'zinc', 'neutral', 'stone', 'red', 'orange', 'amber',
+    'yellow', 'lime', 'green', 'emerald', 'teal', 'cyan', 'sky', 'blue',
+    'indigo', 'violet', 'purple', 'fuchsia', 'pink', 'rose',
+)
+SHADES = (50, 100, 200, 300, 400, 500, 600, 700, 800, 900, 950)
+
+# Classes that look like palette keys but never are
+NOISE = (
+    'flex', 'md:flex', 'rounded-xl', 'p-8', 'md:p-0', 'pt-6', 'md:p-8',
+    'text-center', 'md:text-left', 'space-y-4', 'text-lg', 'font-semibold',
+    'font-medium', 'bg-cover', 'text-ellipsis', 'border-2', 'ring-inset',
+)
+WORDS = (
+    'People', 'who', 'speak', 'honestly', 'about', 'freedom', 'of',
+    'information', 'flatulence', 'InspiroBot', 'colors', 'are', 'amazing',
+)
+
+
+def palette(size, seed=0):
+    """Return a Tailwind-like {key: color} palette with size keys."""
+    rnd = random.Random(seed)
+    colors = {}
+    for variant in VARIANTS:
+        for prefix in PREFIXES:
+            for color in COLORS:
+                for shade in SHADES:
+                    if len(colors) >= size:
+                        return colors
+                    key = '%s%s-%s-%d' % (variant, prefix, color, shade)
+                    colors[key] = '#%06X' % rnd.randrange(0x1000000)
+    n = 0
+    while len(colors) < size:
+        colors['brand-%d' % n] = '#%06X' % rnd.randrange(0x1000000)
+        n += 1
+    return colors
+
+
+def _classes(rnd, keys, density):
+    classes = []
+    for _ in range(rnd.randint(2, 6)):
+        if rnd.random() < density:
+            classes.append(rnd.choice(keys))
+        else:
+            classes.append(rnd.choice(NOISE))
+    return ' '.join(classes)
+
+
+def tailwind(rnd, keys, density):
+    """One block of Tailwind HTML in the shape of example-tailwind.html."""
+    return (
+        '<figure class="%s">\n'
+        '    <div class="%s">\n'
+        '        <blockquote>\n'
+        '            <p class="%s">\n'
+        '                %s\n'
+        '            </p>\n'
+        '        </blockquote>\n'
+        '        <figcaption class="%s">\n'
+        '            <div class="%s">%s</div>\n'
+        '        </figcaption>\n'
+        '    </div>\n'
+        '</figure>\n'
+    ) % (
+        _classes(rnd, keys, density),
+        _classes(rnd, keys, density),
+        _classes(rnd, keys, density),
+        ' '.join(rnd.choice(WORDS) for _ in range(12)),
+        _classes(rnd, keys, density),
+        _classes(rnd, keys, density),
+        rnd.choice(WORDS),
+    )
+
+
+def css(rnd, keys, density):
+    """One CSS rule applying some classes."""
+    return (
+        '.component-%d {\n'
+        '    @apply %s;\n'
+        '    margin: 0 auto; /* %s */\n'
+        '}\n'
+    ) % (rnd.randrange(100000), _classes(rnd, keys, density), rnd.choice(WORDS))
+
+
+def minified(rnd, keys, density):
+    """The CSS rule with all the whitespace a minifier would remove."""
+    return css(rnd, keys, density).replace('\n', '').replace('    ', '').replace(' {', '{')
+
+
+CORPORA = {
+    'tailwind': tailwind,
+    'css': css,
+    'minified': minified,
+}
+
+
+def document(corpus, size, keys, density=0.5, seed=0):
+    """
+    Return a document of about size characters.
+
+    A 64 KB chunk of random blocks is generated and then repeated, which
+    keeps generating 50 MB documents cheap.
+
+    """
+    rnd = random.Random(seed)
+    block = CORPORA[corpus]
+    keys = list(keys)
+    parts = []
+    length = 0
+    while length < min(size, 65536):
+        part = block(rnd, keys, density)
+        parts.append(part)
+        length += len(part)
+    chunk = ''.join(parts)
+    text = chunk * (size // len(chunk) + 1)
+    return text[:size]
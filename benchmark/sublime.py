@@ -0,0 +1,603 @@
+"""
+In-process stand-in for the parts of the `sublime` API the plugin uses.
+
+Views keep their text in a Python string and their regions in dicts, and
+`find_all` runs on Python's `re`, so the plugin can be driven headless.
+Callbacks passed to `set_timeout` are queued until `run_timeouts()`.
+
+"""
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+# Shipped with the package, which the command line scanner is
+from cli import decode_value
+
+HIDDEN = 128
+PERSISTENT = 16
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_EMPTY = 1
+
+LITERAL = 1
+IGNORECASE = 2
+
+MONOKAI = '''{
+    "name": "Monokai",
+    "globals":
+    {
+        "background": "#272822",
+        "foreground": "#F8F8F2"
+    },
+    "rules":
+    [
+        {
+            "scope": "comment",
+            "foreground": "#75715E"
+        },
+        {
+            "scope": "string",
+            "foreground": "#E6DB74"
+        }
+    ]
+}
+'''
+
+# Package resources served by load_resource(), keyed by "Packages/..." path
+RESOURCES = {
+    'Packages/Color Scheme - Default/Monokai.sublime-color-scheme': MONOKAI,
+}
+
+_packages_path = None
+_timeouts = []
+_timeouts_lock = threading.Lock()
+_settings = {}
+_windows = []
+_ids = [0]
+
+
+def _next_id():
+    _ids[0] += 1
+    return _ids[0]
+
+
+def version():
+    return '4169'
+
+
+def platform():
+    return 'linux'
+
+
+def arch():
+    return 'x64'
+
+
+def packages_path():
+    global _packages_path
+    if _packages_path is None:
+        _packages_path = tempfile.mkdtemp(prefix='custom-highlighter-bench-')
+        os.makedirs(os.path.join(_packages_path, 'User'))
+    return _packages_path
+
+
+def cache_path():
+    return os.path.join(packages_path(), 'Cache')
+
+
+def cleanup():
+    """Remove the temporary packages directory."""
+    global _packages_path
+    if _packages_path is not None:
+        shutil.rmtree(_packages_path, ignore_errors=True)
+        _packages_path = None
+
+
+def load_resource(name):
+    path = os.path.join(packages_path(), name[len('Packages/'):])
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read()
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise IOError('resource not found: %s' % name)
+
+
+def find_resources(pattern):
+    return [name for name in RESOURCES if os.path.basename(name) == pattern]
+
+
+def set_timeout(callback, delay=0):
+    with _timeouts_lock:
+        _timeouts.append(callback)
+
+
+set_timeout_async = set_timeout
+
+
+def run_timeouts():
+    """Run the queued set_timeout callbacks (including the ones they queue)."""
+    while True:
+        with _timeouts_lock:
+            if not _timeouts:
+                return
+            callback = _timeouts.pop(0)
+        callback()
+
+
+def score_selector(scope_name, selector):
+    return 1 if any(s.strip() and scope_name.startswith(s.strip()) for s in selector.split(',')) else 0
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    print('error: %s' % msg)
+
+
+def message_dialog(msg):
+    print(msg)
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._callbacks = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def has(self, key):
+        return key in self._values
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def erase(self, key):
+        self._values.pop(key, None)
+
+    def update(self, values):
+        """Replace several values at once, notifying the observers once."""
+        self._values.update(values)
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def to_dict(self):
+        return dict(self._values)
+
+    def add_on_change(self, tag, callback):
+        self._callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self._callbacks.pop(tag, None)
+
+
+def load_settings(base_name):
+    try:
+        return _settings[base_name]
+    except KeyError:
+        settings = _settings[base_name] = Settings()
+        return settings
+
+
+def save_settings(base_name):
+    pass
+
+
+class Region(object):
+    __slots__ = ('a', 'b', 'xpos')
+
+    def __init__(self, a, b=None, xpos=-1):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+        self.xpos = xpos
+
+    def __repr__(self):
+        return 'Region(%d, %d)' % (self.a, self.b)
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, rhs):
+        return isinstance(rhs, Region) and self.a == rhs.a and self.b == rhs.b
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __lt__(self, rhs):
+        lhb = self.begin()
+        rhb = rhs.begin()
+        if lhb == rhb:
+            return self.end() < rhs.end()
+        return lhb < rhb
+
+    def to_tuple(self):
+        return (self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+    def begin(self):
+        return self.a if self.a < self.b else self.b
+
+    def end(self):
+        return self.b if self.a < self.b else self.a
+
+    def size(self):
+        return abs(self.a - self.b)
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def cover(self, rhs):
+        return Region(min(self.begin(), rhs.begin()), max(self.end(), rhs.end()))
+
+    def intersection(self, rhs):
+        if self.end() <= rhs.begin() or rhs.end() <= self.begin():
+            return Region(0, 0)
+        return Region(max(self.begin(), rhs.begin()), min(self.end(), rhs.end()))
+
+    def intersects(self, rhs):
+        lb, le = self.begin(), self.end()
+        rb, re_ = rhs.begin(), rhs.end()
+        return (lb == rb and le == re_) or (rb > lb and rb < le) or (re_ > lb and re_ < le) or (lb > rb and lb < re_) or (le > rb and le < re_)
+
+
+class Selection(object):
+    def __init__(self, regions=None):
+        self._regions = list(regions or [Region(0)])
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __iter__(self):
+        return iter(self._regions)
+
+    def __getitem__(self, index):
+        return self._regions[index]
+
+    def clear(self):
+        del self._regions[:]
+
+    def add(self, region):
+        if not isinstance(region, Region):
+            region = Region(region)
+        self._regions.append(region)
+        self._regions.sort()
+
+    def add_all(self, regions):
+        for region in regions:
+            self.add(region)
+
+
+class HistoricPosition(object):
+    __slots__ = ('pt', 'row', 'col', 'col_utf16', 'col_utf8')
+
+    def __init__(self, pt, row=0, col=0):
+        self.pt = pt
+        self.row = row
+        self.col = col
+        self.col_utf16 = col
+        self.col_utf8 = col
+
+
+class TextChange(object):
+    __slots__ = ('a', 'b', 'len_utf16', 'len_utf8', 'str')
+
+    def __init__(self, a, b, text):
+        self.a = HistoricPosition(a)
+        self.b = HistoricPosition(b)
+        self.str = text
+        self.len_utf16 = b - a
+        self.len_utf8 = b - a
+
+
+class Buffer(object):
+    def __init__(self, buffer_id):
+        self.buffer_id = buffer_id
+        self._views = []
+
+    def id(self):
+        return self.buffer_id
+
+    def views(self):
+        return list(self._views)
+
+    def primary_view(self):
+        return self._views[0] if self._views else None
+
+    def file_name(self):
+        view = self.primary_view()
+        return view.file_name() if view else None
+
+
+class View(object):
+    def __init__(self, text='', file_name=None, window=None, viewport=20000, syntax_scope='text.plain'):
+        self.view_id = _next_id()
+        self._text = text
+        self._file_name = file_name
+        self._window = window
+        self._buffer = Buffer(_next_id())
+        self._buffer._views.append(self)
+        self._settings = Settings()
+        self._sel = Selection()
+        self._regions = {}
+        self._change_count = 0
+        self._viewport = (0, viewport)
+        self._scope = syntax_scope
+        self._style = {'background': '#272822', 'foreground': '#F8F8F2'}
+        self._history = [('insert', {}, 1)]
+        self.commands = []
+
+    def __repr__(self):
+        return 'View(%d)' % self.view_id
+
+    def __eq__(self, other):
+        return isinstance(other, View) and other.view_id == self.view_id
+
+    def __hash__(self):
+        return self.view_id
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self._buffer.buffer_id
+
+    def buffer(self):
+        return self._buffer
+
+    def is_valid(self):
+        return True
+
+    def is_primary(self):
+        return True
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def name(self):
+        return ''
+
+    def is_loading(self):
+        return False
+
+    def is_dirty(self):
+        return False
+
+    def is_scratch(self):
+        return False
+
+    def change_count(self):
+        return self._change_count
+
+    def size(self):
+        return len(self._text)
+
+    def settings(self):
+        return self._settings
+
+    def style(self):
+        return dict(self._style)
+
+    def sel(self):
+        return self._sel
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self._text[x.begin():x.end()]
+        return self._text[x:x + 1]
+
+    def visible_region(self):
+        begin, end = self._viewport
+        return Region(min(begin, self.size()), min(end, self.size()))
+
+    def set_viewport(self, begin, end):
+        """Scroll the stand-in viewport to show [begin, end)."""
+        self._viewport = (begin, end)
+
+    def line(self, x):
+        if isinstance(x, Region):
+            return Region(self.line(x.begin()).begin(), self.line(x.end()).end())
+        begin = self._text.rfind('\n', 0, x) + 1
+        end = self._text.find('\n', x)
+        if end < 0:
+            end = len(self._text)
+        return Region(begin, end)
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.a, min(line.b + 1, self.size()))
+
+    def lines(self, region):
+        lines = []
+        pt = region.begin()
+        end = region.end()
+        while True:
+            line = self.line(pt)
+            lines.append(line)
+            if line.end() >= end or line.end() >= self.size():
+                return lines
+            pt = line.end() + 1
+
+    def rowcol(self, pt):
+        row = self._text.count('\n', 0, pt)
+        return row, pt - (self._text.rfind('\n', 0, pt) + 1)
+
+    def text_point(self, row, col):
+        pt = 0
+        for _ in range(row):
+            pt = self._text.find('\n', pt) + 1
+            if not pt:
+                return self.size()
+        return pt + col
+
+    def find(self, pattern, start_pt, flags=0):
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+        m = re.compile(pattern, re.I if flags & IGNORECASE else 0).search(self._text, start_pt)
+        if not m:
+            return Region(-1, -1)
+        return Region(m.start(), m.end())
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+        regions = []
+        for m in re.compile(pattern, re.I if flags & IGNORECASE else 0).finditer(self._text):
+            regions.append(Region(m.start(), m.end()))
+            if fmt is not None and extractions is not None:
+                extractions.append(m.expand(fmt))
+        return regions
+
+    def scope_name(self, pt):
+        return self._scope + ' '
+
+    def score_selector(self, pt, selector):
+        return score_selector(self._scope, selector)
+
+    def find_by_selector(self, selector):
+        # The whole text is a single token of the syntax scope
+        if self._text and score_selector(self._scope, selector):
+            return [Region(0, self.size())]
+        return []
+
+    def extract_tokens_with_scopes(self, region):
+        if region.empty():
+            return []
+        return [(Region(0, self.size()), self._scope + ' ')]
+
+    def syntax(self):
+        return None
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self._regions[key] = [Region(r.a, r.b) for r in regions]
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, ()))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def region_keys(self):
+        return list(self._regions)
+
+    def command_history(self, index, modifying_only=False):
+        try:
+            return self._history[index - 1]
+        except IndexError:
+            return (None, None, 0)
+
+    def run_command(self, cmd, args=None):
+        self.commands.append((cmd, args))
+
+    def replace_text(self, begin, end, text):
+        """
+        Replace [begin, end) with text the way an edit would.
+
+        Regions are moved like Sublime moves them and the list of TextChange
+        objects a TextChangeListener would receive is returned.
+
+        """
+        delta = len(text) - (end - begin)
+
+        def shift(pt):
+            if pt < begin:
+                return pt
+            if pt >= end:
+                return pt + delta
+            return begin
+
+        self._text = self._text[:begin] + text + self._text[end:]
+        self._change_count += 1
+        for key, regions in self._regions.items():
+            self._regions[key] = [Region(shift(r.a), shift(r.b)) for r in regions]
+        return [TextChange(begin, end, text)]
+
+
+class Window(object):
+    def __init__(self):
+        self.window_id = _next_id()
+        self._views = []
+        self._active = None
+        self._project_data = None
+        self._folders = []
+
+    def id(self):
+        return self.window_id
+
+    def is_valid(self):
+        return True
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._active or (self._views[0] if self._views else None)
+
+    def focus_view(self, view):
+        self._active = view
+
+    def num_groups(self):
+        return 1
+
+    def active_group(self):
+        return 0
+
+    def views_in_group(self, group):
+        return list(self._views)
+
+    def active_view_in_group(self, group):
+        return self.active_view()
+
+    def folders(self):
+        return list(self._folders)
+
+    def project_data(self):
+        return self._project_data
+
+    def project_file_name(self):
+        return None
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1, on_highlight=None):
+        pass
+
+    def run_command(self, cmd, args=None):
+        pass
+
+    def new_view(self, text='', file_name=None, **kwargs):
+        """Open a stand-in view holding text in this window."""
+        view = View(text, file_name=file_name, window=self, **kwargs)
+        self._views.append(view)
+        if self._active is None:
+            self._active = view
+        return view
+
+    def close_view(self, view):
+        self._views.remove(view)
+        if self._active is view:
+            self._active = None
+
+
+def windows():
+    if not _windows:
+        _windows.append(Window())
+    return list(_windows)
+
+
+def active_window():
+    return windows()[0]
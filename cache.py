@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+MANIFEST = 'manifest.json'
+
+
+class LRUCache(object):
+    """At most max_size values by key, the least recently used ones are dropped first."""
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > max(self.max_size, 1):
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class ManifestCache(object):
+    """
+    A directory of cache files, bounded by a count and a size cap.
+
+    A manifest in the directory keeps the size and last use of every file.
+    When the cache is over a cap, the least recently used files are removed,
+    except, with keep_used, the files used since the cache was created (such
+    as the icons shown in the views). The manifest is made from the
+    directory contents when it is missing, and reconciled with them when it
+    is loaded.
+
+    """
+
+    def __init__(self, path, max_files=0, max_size=0, keep_used=True):
+        self.path = path
+        self.max_files = max_files  # 0 means no limit
+        self.max_size = max_size  # in bytes, 0 means no limit
+        self.keep_used = keep_used
+        self.entries = OrderedDict()  # {name: [size, last_use]}, least recently used first
+        self.size = 0
+        self.started = time.time()
+        self.loaded = False
+        self.dirty = False
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name, size):
+        """Record that the file name of size bytes was just written."""
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old:
+                self.size -= old[0]
+            self.entries[name] = [size, time.time()]
+            self.size += size
+            self.dirty = True
+
+    def touch(self, name):
+        """Record the use of an existing file, call with the lock held."""
+        entry = self.entries.get(name)
+        if entry is None:
+            try:
+                size = os.path.getsize(self.file_path(name))
+            except OSError:
+                return
+            entry = self.entries[name] = [size, 0]
+            self.size += size
+        else:
+            self.entries.move_to_end(name)
+        entry[1] = time.time()
+        self.dirty = True
+
+    def over_limit(self):
+        return (
+            (self.max_files and len(self.entries) > self.max_files) or
+            (self.max_size and self.size > self.max_size)
+        )
+
+    def load(self):
+        """Read the manifest and reconcile it with the files in the directory."""
+        try:
+            names = set(name for name in os.listdir(self.path) if name != MANIFEST and not name.endswith('.tmp'))
+        except OSError:
+            names = set()
+
+        try:
+            with open(self.file_path(MANIFEST)) as fp:
+                stored = json.load(fp)['entries']
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            stored = []
+            self.dirty = True
+
+        entries = {}
+        for name, size, last_use in stored:
+            if name in names:
+                entries[name] = [size, last_use]
+        for name in names.difference(entries):
+            # Not in the manifest, its modification time is the best guess
+            try:
+                stat = os.stat(self.file_path(name))
+            except OSError:
+                continue
+            entries[name] = [stat.st_size, stat.st_mtime]
+            self.dirty = True
+        if len(entries) != len(stored):
+            self.dirty = True
+
+        with self.lock:
+            # Files recorded before loading are the most recently used ones
+            for name, entry in self.entries.items():
+                entries[name] = entry
+            self.entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1][1]))
+            self.size = sum(size for size, _ in self.entries.values())
+            self.loaded = True
+
+    def evict(self):
+        """Remove the least recently used files until the cache is within its caps."""
+        removed = []
+        with self.lock:
+            for name in list(self.entries):
+                if not self.over_limit():
+                    break
+                size, last_use = self.entries[name]
+                if self.keep_used and last_use >= self.started:
+                    break  # in use, and so is everything after it
+                del self.entries[name]
+                self.size -= size
+                try:
+                    os.remove(self.file_path(name))
+                except OSError:
+                    pass
+                removed.append(name)
+            if removed:
+                self.dirty = True
+        return removed
+
+    def save(self):
+        """Write the manifest, if anything changed since it was last written."""
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [[name, size, last_use] for name, (size, last_use) in self.entries.items()]
+            self.dirty = False
+
+        if not os.path.exists(self.path):
+            return
+        path = self.file_path(MANIFEST)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as fp:
+            json.dump({'entries': entries}, fp)
+        os.replace(tmp_path, path)
+
+    def maintain(self):
+        """Load the manifest the first time, evict what is over the caps and save."""
+        self.scheduled = False
+        if not self.loaded:
+            self.load()
+        self.evict()
+        self.save()
+
+    def schedule(self, executor):
+        """Run maintain() on executor, unless it is already waiting to run."""
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        executor.submit(self.maintain)
+
+
+def pack_matches(found):
+    """Encode sorted (begin, end, key) matches as deltas of the begins, lengths and key indexes."""
+    keys = sorted(set(key for _, _, key in found))
+    index = dict((key, i) for i, key in enumerate(keys))
+    numbers = []
+    last = 0
+    for begin, end, key in found:
+        numbers.extend((begin - last, end - begin, index[key]))
+        last = begin
+    return zlib.compress(json.dumps({'keys': keys, 'matches': numbers}, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack_matches(data):
+    packed = json.loads(zlib.decompress(data).decode('utf-8'))
+    keys = packed['keys']
+    numbers = packed['matches']
+    found = []
+    begin = 0
+    for i in range(0, len(numbers), 3):
+        begin += numbers[i]
+        found.append((begin, begin + numbers[i + 1], keys[numbers[i + 2]]))
+    return found
+
+
+class MatchCache(ManifestCache):
+    """
+    The matches found in texts scanned before, by the digests of the text
+    and of the palette keys, as a ManifestCache of packed match files.
+
+    Match files are only read once per pass, so unlike icons the ones used
+    in this session may be evicted too.
+
+    """
+
+    def __init__(self, path, max_files=0, max_size=0):
+        super(MatchCache, self).__init__(path, max_files, max_size, keep_used=False)
+
+    def name(self, text_digest, palette_digest):
+        return '%s-%s' % (text_digest, palette_digest[:16])
+
+    def get(self, text_digest, palette_digest):
+        """Return the matches stored for the text and palette, or None."""
+        name = self.name(text_digest, palette_digest)
+        try:
+            with open(self.file_path(name), 'rb') as fp:
+                found = unpack_matches(fp.read())
+        except (OSError, IOError, ValueError, KeyError, TypeError, IndexError, zlib.error):
+            return None
+        with self.lock:
+            self.touch(name)
+        return found
+
+    def put(self, text_digest, palette_digest, found):
+        name = self.name(text_digest, palette_digest)
+        data = pack_matches(found)
+        path = self.file_path(name)
+        tmp_path = '%s.tmp' % path
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            with open(tmp_path, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self.add(name, len(data))
@@ -0,0 +1,97 @@
+"""
+Headless color key scanner for Custom Highlighter.
+
+Run from the package directory with `python -m cli --help`. Only the plugin
+modules that do not need Sublime Text (palette, matcher, indexer) are
+imported, as a package, so keys are found exactly as the plugin finds them;
+files are read and scanned by the indexer's helpers, as the project index
+does. The benchmark suite, which is not shipped, loads the plugin with the
+helpers here too.
+
+"""
+import os
+import re
+import sys
+import json
+import types
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'custom_highlighter'
+SETTINGS = os.path.join(ROOT, 'Custom Highlighter.sublime-settings')
+
+
+def load_module(name):
+    """Import one of the package modules as part of the package, so relative imports work."""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module('%s.%s' % (PACKAGE, name))
+
+
+_comments_re = re.compile(r'("(?:\\.|[^"\\])*")|/\*.*?\*/|//[^\n]*', re.S)
+_trailing_commas_re = re.compile(r',(\s*[\]}])')
+
+
+def decode_value(data):
+    """Decode JSON the way Sublime does, allowing comments and trailing commas."""
+    data = _comments_re.sub(lambda m: m.group(1) or '', data)
+    data = _trailing_commas_re.sub(r'\1', data)
+    return json.loads(data)
+
+
+# Registered on import, so worker processes can unpickle the matchers
+palette = load_module('palette')
+matcher = load_module('matcher')
+indexer = load_module('indexer')
+
+
+def load_layers(paths):
+    """
+    Return the palette layers of the default settings and of paths, in order.
+
+    A .sublime-project file gives the custom_highlighter entry of its
+    settings, any other file is read as Custom Highlighter settings.
+
+    """
+    layers = []
+    for path in [SETTINGS] + list(paths):
+        with open(path) as fp:
+            data = decode_value(fp.read())
+        if path.endswith('.sublime-project'):
+            data = (data.get('settings') or {}).get('custom_highlighter') or {}
+        layers.append(data)
+    return layers
+
+
+def load_palette(layers, syntax=None, engine=None):
+    """Return the Palette and matcher of layers, as the plugin layers them for a view of syntax."""
+    if syntax:
+        layers = layers + [(layer.get('syntaxes') or {}).get(syntax) for layer in layers]
+    layers = [layer for layer in layers if layer]
+    colors, families = palette.layer_colors(layers)
+    result = palette.Palette(colors, families=families)
+    if engine is None:
+        engine = next((layer['matcher'] for layer in reversed(layers) if layer.get('matcher')), None)
+    return result, matcher.create_matcher(result.names, engine, result.families)
+
+
+# The matcher of a worker process, set once by init_worker() rather than sent with every file
+_matcher = None
+
+
+def init_worker(matcher):
+    global _matcher
+    _matcher = matcher
+
+
+def scan_file(path):
+    """Return (path, matches, error) for path, using the matcher given to init_worker()."""
+    try:
+        text = indexer.read_text(path)
+    except (OSError, IOError) as e:
+        return path, [], str(e)
+    if text is None:
+        return path, [], None  # binary
+    return path, list(indexer.iter_positions(_matcher, text)), None
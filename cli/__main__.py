@@ -0,0 +1,108 @@
+"""
+Find the keys of a Custom Highlighter palette in files, outside Sublime Text.
+
+    python -m cli --settings "Custom Highlighter.sublime-settings" src/
+    python -m cli --settings my.sublime-project --syntax CSS --format counts styles/
+    git diff --name-only | python -m cli --settings palette.sublime-settings --check -
+
+The palette is the package defaults, then every --settings file in order
+(a .sublime-project gives its custom_highlighter settings), then their
+"syntaxes" entries for --syntax. JSON lines print one match per line as
+files are scanned; counts print the number of matches of every key.
+
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import Counter
+
+from . import indexer, load_layers, load_palette, init_worker, scan_file
+
+FORMATS = ('jsonl', 'counts')
+
+
+def iter_paths(paths, exclude):
+    """Yield the files of paths, walking directories; '-' reads paths from stdin."""
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line
+        elif os.path.isdir(path):
+            for name, _, _ in indexer.iter_files([path], exclude, exclude, max_size=float('inf')):
+                yield name
+        else:
+            yield path
+
+
+def scan(paths, matcher, jobs):
+    """Yield scan_file() results, in the order of paths, from jobs worker processes."""
+    if jobs <= 1:
+        init_worker(matcher)
+        for path in paths:
+            yield scan_file(path)
+        return
+
+    pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(matcher,))
+    try:
+        for result in pool.imap(scan_file, paths, chunksize=8):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m cli', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="files or directories to scan, - reads paths from stdin")
+    parser.add_argument('--settings', action='append', default=[], help='settings or .sublime-project file with the palette (repeatable, later ones win)')
+    parser.add_argument('--syntax', help='apply the "syntaxes" palette layers of this syntax name')
+    parser.add_argument('--matcher', choices=('trie', 'regex'), help='matching engine (default: the "matcher" setting)')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes (1 scans in this process)')
+    parser.add_argument('--exclude', action='append', default=['.git', '.hg', '.svn'], help='file or directory name pattern to skip')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 when any key is found')
+    args = parser.parse_args(argv)
+
+    palette, matcher = load_palette(load_layers(args.settings), syntax=args.syntax, engine=args.matcher)
+    for key, value in sorted(palette.invalid.items()):
+        sys.stderr.write('Invalid color for %r: %r\n' % (key, value))
+    if not len(palette):
+        parser.error('no colors configured, pass the settings with --settings')
+
+    out = sys.stdout
+    counts = Counter()
+    failed = False
+    for path, matches, error in scan(iter_paths(args.paths, args.exclude), matcher, args.jobs):
+        if error is not None:
+            sys.stderr.write('%s: %s\n' % (path, error))
+            failed = True
+            continue
+        if args.format == 'jsonl':
+            for offset, line, column, key in matches:
+                out.write(json.dumps({
+                    'path': path,
+                    'line': line,
+                    'column': column,
+                    'offset': offset,
+                    'key': key,
+                    'color': palette.colors[palette.get(key)],
+                }) + '\n')
+            out.flush()
+        counts.update(key for _, _, _, key in matches)
+
+    if args.format == 'counts':
+        for key, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            out.write('%d\t%s\n' % (count, key))
+
+    if failed:
+        return 2
+    if args.check and counts:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
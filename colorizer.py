@@ -2,15 +2,24 @@ import os
 import re
 import json
 import errno
-import plistlib
-import datetime
+import time
+import threading
 
 import sublime
 
+from .palette import contrast_color
+from .stats import Rolling
+
 # from .colors import names_to_hex, xterm_to_hex, xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex
 
 DEFAULT_COLOR_SCHEME = 'Monokai.sublime-color-scheme'
 
+# Colors added within this many milliseconds are written to the scheme at once
+SCHEME_WRITE_DELAY = 100
+
+# The overlay is checked for outside changes at most once per this many seconds
+SCHEME_CHECK_INTERVAL = 1
+
 # all_names_to_hex = dict(names_to_hex, **xterm_to_hex)
 # all_names_to_hex = dict();
 
@@ -29,11 +38,6 @@ class Log(object):
 log = Log()
 
 
-if not hasattr(plistlib, 'loads'):
-    plistlib.loads = lambda data: plistlib.readPlistFromBytes(data)
-    plistlib.dumps = lambda value: plistlib.writePlistToBytes(value)
-
-
 def write_package(path, content):
     rf = sublime.packages_path() + path
     try:
@@ -57,152 +61,152 @@ def read_package(path):
 
 
 class ColorScheme(object):
-    backup_ext = ".chback"
+    """
+    The color scheme of a view, and the overlay the colorizer rules go to.
 
-    def __init__(self, settings):
-        path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
+    Sublime merges Packages/User/<name>.sublime-color-scheme into the scheme
+    named <name> (either .sublime-color-scheme or .tmTheme), so the rules are
+    written there instead of into a copy of the whole scheme.
 
+    """
+    backup_ext = ".chback"
+
+    def __init__(self, path):
         if not path.startswith('Packages/'):
             path = 'Packages/Color Scheme - Default/' + path
 
         self.path = path[8:]
-        self.time = datetime.datetime.now()
-
-    def hash(self):
-        if not hasattr(self, '_hash'):
-            self._hash = hash(self.content())
+        self.overlay_path = '/User/%s.sublime-color-scheme' % os.path.splitext(os.path.basename(self.path))[0]
+        self.stamp = self.overlay_stamp()
+        self.checked = time.time()
+        self.emitted = None  # scopes of the overlay rules, once it is read
 
-        return self._hash
+    def overlay_stamp(self):
+        try:
+            stat = os.stat(sublime.packages_path() + self.overlay_path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def changed(self):
+        '''Whether the overlay was changed by someone else, checked at most once per SCHEME_CHECK_INTERVAL'''
+        now = time.time()
+        if now - self.checked < SCHEME_CHECK_INTERVAL:
+            return False
+        self.checked = now
+        return self.overlay_stamp() != self.stamp
 
     def restore(self):
-        # Remove "Packages" part from name
-        if not os.path.exists(sublime.packages_path() + self.path + self.backup_ext):
+        restored = False
+
+        # Schemes changed in place by older versions have a backup of their own
+        for path in (self.path, self.overlay_path):
+            if os.path.exists(sublime.packages_path() + path + self.backup_ext):
+                log.debug("Starting restore scheme: " + path)
+                write_package(path, read_package(path + self.backup_ext))
+                log.debug("Restore done.")
+                restored = True
+            elif path == self.overlay_path and os.path.exists(sublime.packages_path() + path):
+                os.remove(sublime.packages_path() + path)  # generated by us alone
+                log.debug("Removed overlay scheme: " + path)
+                restored = True
+
+        if hasattr(self, '_overlay'):
+            del self._overlay
+        self.emitted = None
+        self.stamp = self.overlay_stamp()
+
+        if not restored:
             log.debug("No backup :(")
-            return False
 
-        log.debug("Starting restore scheme: " + self.path)
-        write_package(self.path, read_package(self.path + self.backup_ext))
-        log.debug("Restore done.")
+        return restored
 
-        return True
-
-    def backup(self, content):
-        if os.path.exists(sublime.packages_path() + self.path + self.backup_ext):
+    def backup(self, path, content):
+        if os.path.exists(sublime.packages_path() + path + self.backup_ext):
             log.debug("Already backed up")
             return False
 
-        write_package(self.path + self.backup_ext, content)  # backup
+        write_package(path + self.backup_ext, content)  # backup
         log.debug("Backup done")
 
         return True
 
-    def content(self):
-        if not hasattr(self, '_content'):
-            # Remove "Packages" part from name
-            content = read_package(self.path)
-            self.backup(content)
-            self._content = content
-
-        return self._content
+    def overlay(self, foreign=None):
+        '''
+        Return the overlay scheme as a dict ({} if there is none yet), or None if it can't be read.
+
+        If the overlay has rules for which foreign(rule) is true, or anything
+        but rules, it was written by the user and is backed up first.
+        '''
+        if not hasattr(self, '_overlay'):
+            rf = sublime.packages_path() + self.overlay_path
+            overlay = {}
+            if os.path.exists(rf):
+                with open(rf, 'r') as f:
+                    content = f.read()
+                try:
+                    overlay = sublime.decode_value(content)
+                except ValueError as e:
+                    log.error("Invalid overlay scheme %s: %r" % (self.overlay_path, e))
+                    return None
+                if set(overlay) - set(['rules']) or any(foreign(rule) for rule in overlay.get('rules', []) if foreign):
+                    self.backup(self.overlay_path, content)
+            self._overlay = overlay
+            self.emitted = set(rule.get('scope') for rule in overlay.get('rules', []))
+
+        return self._overlay
+
+    def scopes(self, foreign=None):
+        '''The set of the scopes the overlay has rules for, read once'''
+        if self.emitted is None:
+            if self.overlay(foreign) is None:
+                return set()
+
+        return self.emitted
+
+    def write_overlay(self, overlay, added=None):
+        write_package(self.overlay_path, json.dumps(overlay, indent=4))
+        self._overlay = overlay
+        if added is not None:
+            self.emitted.update(added)
+        else:
+            self.emitted = set(rule.get('scope') for rule in overlay.get('rules', []))
+        self.stamp = self.overlay_stamp()
 
 
 class SchemaColorizer(object):
     prefix = "col_"
 
     colors = {}
+    pending = {}  # colors added but not written yet
+    palette = None
     color_scheme = None
+    schemes = {}  # ColorScheme per color_scheme setting
     need_update = False
-
-    def normalize(self, col, colors):
-        # print({
-        #     "normalize": col,
-        # })
-        try:
-            color = colors[col].upper()
-        except Exception:
-            # print("Invalid color: %r" % col)
-            return
-
-        # if col:
-            # col = all_names_to_hex.get(col.lower(), col.upper())
-            # col = self.all_colors.get(col)
-            # if col.startswith('0X'):
-            #     col = '#' + col[2:]
-
-        try:
-            # if col[0] != '#':
-            #     raise ValueError
-
-            if len(color) == 4: #abc
-                color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + 'FF'
-            elif len(color) == 5: #abcd
-                color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + color[4] * 2
-            elif len(color) == 7: #aabbcc
-                color += 'FF'
-
-            if re.match(r'^#[A-F0-9]{8}$', color) == None:
-                raise ValueError('Invalid color format "%s"' % color)
-
-            r = int(color[1:3], 16)
-            g = int(color[3:5], 16)
-            b = int(color[5:7], 16)
-            a = int(color[7:9], 16) or 1  # alpha == 0 doesn't apply alpha in Sublime
-
-            # print({
-            #     "color": color,
-            #     "r": r,
-            #     "g": g,
-            #     "b": b,
-            #     "a": a,
-            # })
-
-            return '#%02X%02X%02X%02X' % (r, g, b, a)
-        except Exception:
-            print("Invalid color: %r" % color)
+    write_pending = False
+    rebuild = False
+    retained = None
+    bg_col = None
+    lock = threading.Lock()
+    write_times = Rolling()  # ms taken by the writes of the overlay
 
     def get_inv_col(self, bg_col, col):
-        br = int(bg_col[1:3], 16)
-        bg = int(bg_col[3:5], 16)
-        bb = int(bg_col[5:7], 16)
-
-        r = int(col[1:3], 16)
-        g = int(col[3:5], 16)
-        b = int(col[5:7], 16)
-        a = int(col[7:9], 16) / 255.0
-
-        r = br * (1 - a) + r * a
-        g = bg * (1 - a) + g * a
-        b = bb * (1 - a) + b * a
-
-        # L = (max(r, g, b) + min(r, g, b)) / 2
-        # Y709 = 0.2126 * r + 0.7152 * g + 0.0722 * b
-        Y601 = ((r * 299) + (g * 587) + (b * 114)) / 1000
-
-        v = Y601
-
-        if v >= 128:
-            v -= 128
-        else:
-            v += 128
-
-        return '#%sFF' % (('%02X' % v) * 3)
+        if self.palette is not None:
+            return self.palette.foreground(col, bg_col)
+        return contrast_color(bg_col, col)
 
     def region_name(self, s):
         return self.prefix + s[1:]
 
-    def add_color(self, col, colors):
-        # print({"add_color": col})
-        col = self.normalize(col, colors)
-        # print({"add_color": col})
-
-        if not col:
-            return
-
-        if col not in self.colors:
-            self.colors[col] = self.region_name(col)
+    def add_color(self, col):
+        name = self.colors.get(col)
+        if name is None:
+            name = self.colors[col] = self.region_name(col)
+            with self.lock:
+                self.pending[col] = name
             self.need_update = True
 
-        return self.colors[col]
+        return name
 
     def current_views(self):
         for window in sublime.windows():
@@ -219,82 +223,133 @@ class SchemaColorizer(object):
         return '#333333FF'
 
     def update(self, view):
+        '''Schedule writing the colors added since the last update to the scheme'''
         if not self.need_update:
             return
 
         self.need_update = False
+        self.bg_col = self.get_background_col(view)
+        self.schedule()
+
+    def schedule(self):
+        with self.lock:
+            if self.write_pending:
+                return
+            self.write_pending = True
 
-        content = self.color_scheme.content()
-        current_colors = set("#%s" % c.upper() for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+        sublime.set_timeout_async(self.flush, SCHEME_WRITE_DELAY)
 
-        bg_col = self.get_background_col(view)
+    def flush(self):
+        with self.lock:
+            self.write_pending = False
 
-        rules = []
+        if self.color_scheme is not None:
+            self.write(self.bg_col)
+
+    def preseed(self, colors, view):
+        '''Add the rules of all the given colors to the scheme in a single write'''
+        for col in colors:
+            self.add_color(col)
+        self.need_update = False
+        self.write(self.get_background_col(view))
+
+    def retain(self, colors):
+        '''Drop the rules of the colors not given from the scheme, when the palette changes'''
+        self.retained = set(colors)
+        self.colors = dict((col, name) for col, name in self.colors.items() if col in self.retained)
+        with self.lock:
+            self.pending = dict((col, name) for col, name in self.pending.items() if col in self.retained)
+        self.rebuild = True
+        if self.bg_col is not None:
+            self.schedule()
+
+    def is_rule(self, rule):
+        return rule.get('scope', '').startswith(self.prefix)
+
+    def is_foreign(self, rule):
+        return not self.is_rule(rule)
+
+    def write(self, bg_col):
+        start = time.time()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        # Decided from the scopes already written, without reading the overlay
+        scopes = self.color_scheme.scopes(self.is_foreign)
+        gutter = '%sgutter' % self.prefix
+        new = [(col, name) for col, name in pending.items() if name not in scopes]
+        if not new and not self.rebuild and gutter in scopes:
+            return
 
-        if not re.search(r'\b%sgutter\b' % self.prefix, content):
+        overlay = self.color_scheme.overlay(self.is_foreign)
+        if overlay is None:
+            log.error("Not Updated: overlay scheme can't be read")
+            return
+
+        current_rules = overlay.get('rules', [])
+        rebuild = self.rebuild
+        if rebuild:
+            self.rebuild = False
+            keep = set(self.colors.values())
+            keep.add(gutter)
+            rules = [rule for rule in current_rules if not self.is_rule(rule) or rule['scope'] in keep]
+        else:
+            rules = list(current_rules)
+
+        added = []
+        if gutter not in scopes:
             rules.append({
-                "scope": "%sgutter" % self.prefix,
+                "scope": gutter,
                 "background": "#000000",
                 "foreground": "#ffffff",
             })
-        for col, name in self.colors.items():
-            if col not in current_colors:
-                fg_col = self.get_inv_col(bg_col, col)
-                rules.append({
-                    "scope": name,
-                    "background": col,
-                    "foreground": fg_col,
-                })
-
-        if rules:
+            added.append(gutter)
+        for col, name in new:
+            fg_col = self.get_inv_col(bg_col, col)
+            rules.append({
+                "scope": name,
+                "background": col,
+                "foreground": fg_col,
+            })
+            added.append(name)
+
+        if rules != current_rules:
             try:
-                # For sublime-color-scheme
-                m = re.search(r'([\t ]*)"rules":\s*\[[\r\n]*', content)
-                if m:
-                    json_rules = json.dumps({"rules": rules}, indent=m.group(1))
-                    json_rules = '\n'.join(map(str.rstrip, json_rules.split('\n')[2:-2])) + ',\n'
-                    content = content[:m.end()] + json_rules + content[m.end():]
-                    write_package(self.color_scheme.path, content)
-                    log.debug("Updated sublime-color-scheme")
-                    return
-
-                # for tmTheme
-                if re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
-                    plist_content = plistlib.loads(content.encode('utf-8'))
-                    plist_content['settings'].extend({
-                        "scope": r['scope'],
-                        "settings": {
-                            "foreground": r['foreground'],
-                            "background": r['background'],
-                        }
-                    } for r in rules)
-                    content = plistlib.dumps(plist_content).decode('utf-8')
-                    write_package(self.color_scheme.path, content)
-                    log.debug("Updated tmTheme")
-                    return
-
-                log.error("Not Updated: Schema format not recognized")
+                overlay = dict(overlay, rules=rules)
+                self.color_scheme.write_overlay(overlay, None if rebuild else added)
+                self.write_times.add((time.time() - start) * 1000)
+                log.debug("Updated overlay scheme")
             except Exception as e:
                 import traceback; traceback.print_exc();
                 log.error("Not Updated: %r" % e)
+                with self.lock:
+                    self.pending.update(new)
 
     def clear(self):
         self.colors = {}
+        with self.lock:
+            self.pending = {}
 
-    def setup_color_scheme(self, settings):
-        color_scheme = ColorScheme(settings)
-        if self.color_scheme and self.color_scheme.path == color_scheme.path:
-            if self.color_scheme.time + datetime.timedelta(seconds=1) > color_scheme.time:
-                return
+    def invalidate(self):
+        '''Forget the resolved schemes, when the settings change'''
+        self.schemes = {}
+        self.color_scheme = None
 
-            if self.color_scheme.hash() == color_scheme.hash():
-                self.color_scheme.time = color_scheme.time
+    def setup_color_scheme(self, settings):
+        path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
+        color_scheme = self.schemes.get(path)
+        if color_scheme is not None and not color_scheme.changed():
+            if color_scheme is self.color_scheme:
                 return
+        else:
+            color_scheme = self.schemes[path] = ColorScheme(path)
 
         log.debug("Color scheme %s setup" % color_scheme.path)
         self.color_scheme = color_scheme
-        content = self.color_scheme.content()
-        self.colors = dict(("#%s" % c, "%s%s" % (self.prefix, c)) for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+        scopes = self.color_scheme.scopes(self.is_foreign)
+        self.colors = dict(("#%s" % m.group(1), m.group(0)) for m in (re.match(r'%s([A-F0-9]{8})\Z' % self.prefix, scope or '') for scope in scopes) if m)
+        if self.rebuild and self.retained is not None:
+            self.colors = dict((col, name) for col, name in self.colors.items() if col in self.retained)
 
     def restore_color_scheme(self):
         # do not support empty color scheme
@@ -303,4 +358,4 @@ class SchemaColorizer(object):
             return
 
         if self.color_scheme.restore():
-            self.colors = {}
+            self.clear()
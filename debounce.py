@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+# Bounds of the chosen delays, in milliseconds
+MIN_DELAY = 50
+MAX_DELAY = 3000
+
+# Delay after cursor movement, when there are no latency samples yet
+MOVEMENT_DELAY = 1000
+
+# Edits further apart than this (ms) end a typing burst and are not a cadence sample
+BURST_GAP = 2000
+
+Decision = namedtuple('Decision', 'delay delay_when_busy latency cadence')
+
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class DebounceController(object):
+    """
+    Picks the highlight delays of a view from its scan latency and typing cadence.
+
+    A pass taking L ms, started at most every delay + L ms, keeps the share
+    of time spent highlighting under busy_share when
+    delay >= L * (1 - busy_share) / busy_share. When the user types just a
+    little slower than that delay, passes would start between keystrokes
+    only to be cancelled by the next one, so the delay is stretched past the
+    typing interval to wait for a pause instead.
+
+    """
+
+    def __init__(self, busy_share=0.2):
+        self.busy_share = busy_share
+
+    def latency(self, latency):
+        """Pessimistic latency estimate (ms), None without samples."""
+        if not latency.count:
+            return None
+        return max(latency.ewma, latency.percentile(90))
+
+    def decide(self, latency, cadence):
+        """Return a Decision for the Rolling latency and cadence samples of a view, or None without latency samples."""
+        estimate = self.latency(latency)
+        if estimate is None:
+            return None
+
+        share = clamp(self.busy_share, 0.01, 1)
+        delay = estimate * (1 - share) / share
+
+        interval = cadence.percentile(75) if len(cadence) >= 4 else None
+        if interval is not None and delay < interval < delay * 2:
+            delay = interval * 1.25
+
+        delay = int(clamp(delay, MIN_DELAY, MAX_DELAY))
+        delay_when_busy = int(clamp(delay * 2.5, delay, MAX_DELAY))
+        return Decision(delay, delay_when_busy, estimate, interval)
+
+    def movement_delay(self, latency):
+        """How long (ms) to hold the queue back after the cursor moves."""
+        estimate = self.latency(latency)
+        if estimate is None:
+            return MOVEMENT_DELAY
+        return int(clamp(estimate * 2, 100, MOVEMENT_DELAY))
@@ -0,0 +1,201 @@
+import os
+import json
+import fnmatch
+import threading
+from collections import Counter
+
+# Files larger than this many bytes are not indexed
+MAX_FILE_SIZE = 4 * 1024 * 1024
+
+# Files with a NUL byte in their first bytes are taken as binary and skipped
+BINARY_SNIFF = 8192
+
+
+def is_excluded(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def iter_files(folders, folder_exclude_patterns=(), file_exclude_patterns=(), max_size=MAX_FILE_SIZE):
+    """Yield (path, mtime, size) for the files to index under folders."""
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [name for name in dirs if not is_excluded(name, folder_exclude_patterns)]
+            for name in files:
+                if is_excluded(name, file_exclude_patterns):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size > max_size:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+
+def read_text(path):
+    """Return the text of path, or None if it is binary."""
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if data.find(b'\0', 0, BINARY_SNIFF) != -1:
+        return None
+    return data.decode('utf-8', 'replace')
+
+
+def iter_positions(matcher, text):
+    """Yield (offset, row, col, key) for the matches of matcher in text, row and col 1-based."""
+    row = 1
+    line_start = 0
+    last = 0
+    for begin, end, key in matcher.finditer(text):
+        newlines = text.count('\n', last, begin)
+        if newlines:
+            row += newlines
+            line_start = text.rfind('\n', last, begin) + 1
+        last = begin
+        yield begin, row, begin - line_start + 1, key
+
+
+def find_positions(matcher, text):
+    """Return {key: [[row, col], ...]} (1-based) for the matches of matcher in text."""
+    positions = {}
+    for _, row, col, key in iter_positions(matcher, text):
+        positions.setdefault(key, []).append([row, col])
+    return positions
+
+
+def scan_file(job):
+    """
+    Scan one (path, matcher) job, return (path, positions), positions None if unreadable.
+
+    A plain function, so it can be sent to a process pool.
+
+    """
+    path, matcher = job
+    try:
+        text = read_text(path)
+    except (OSError, IOError):
+        return path, None
+    if text is None:
+        return path, {}
+    return path, find_positions(matcher, text)
+
+
+class ProjectIndex(object):
+    """
+    Where the keys of a palette are used in the files of some folders.
+
+    The index is inverted, {key: {path: [[row, col], ...]}}, and saved to
+    path along with the modification time and size of every file, so a
+    refresh only scans again the files that changed. Changing the keys (the
+    digest of the palette) drops the whole index.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.digest = None
+        self.files = {}  # {path: [mtime, size, [keys]]}
+        self.keys = {}  # {key: {path: [[row, col], ...]}}
+        self.indexing = False  # set by whoever runs refresh() in the background
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                stored = json.load(fp)
+            digest, files, keys = stored['digest'], stored['files'], stored['keys']
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            return False
+        with self.lock:
+            self.digest = digest
+            self.files = files
+            self.keys = keys
+        return True
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'digest': self.digest, 'files': self.files, 'keys': self.keys}, separators=(',', ':'))
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as fp:
+            fp.write(data)
+        os.replace(tmp_path, self.path)
+
+    def forget(self, path):
+        """Drop the usages in path, call with the lock held."""
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+        for key in entry[2]:
+            usages = self.keys.get(key)
+            if usages is not None:
+                usages.pop(path, None)
+                if not usages:
+                    del self.keys[key]
+
+    def refresh(self, folders, matcher, digest, executor=None, progress=None, **walk):
+        """
+        Scan the files under folders that changed since the last refresh.
+
+        Files are scanned with executor.map() if given (threads or
+        processes), progress(done, total) is called as they are merged.
+        Returns the number of files scanned and of files dropped.
+
+        """
+        with self.lock:
+            if digest != self.digest:
+                self.digest = digest
+                self.files = {}
+                self.keys = {}
+            known = self.files
+
+        current = {}
+        changed = []
+        for path, mtime, size in iter_files(folders, **walk):
+            current[path] = (mtime, size)
+            entry = known.get(path)
+            if entry is None or entry[0] != mtime or entry[1] != size:
+                changed.append(path)
+
+        with self.lock:
+            removed = [path for path in self.files if path not in current]
+            for path in removed:
+                self.forget(path)
+
+        jobs = [(path, matcher) for path in changed]
+        if executor is not None and len(jobs) > 1:
+            results = executor.map(scan_file, jobs)
+        else:
+            results = map(scan_file, jobs)
+
+        for done, (path, positions) in enumerate(results, 1):
+            with self.lock:
+                self.forget(path)
+                if positions is not None:
+                    mtime, size = current[path]
+                    self.files[path] = [mtime, size, sorted(positions)]
+                    for key, found in positions.items():
+                        self.keys.setdefault(key, {})[path] = found
+            if progress is not None:
+                progress(done, len(jobs))
+
+        return len(changed), len(removed)
+
+    def usages(self, key):
+        """Return [(path, row, col), ...] of key, sorted."""
+        with self.lock:
+            usages = self.keys.get(key, {})
+            return sorted((path, row, col) for path, found in usages.items() for row, col in found)
+
+    def counts(self):
+        """Return a Counter of the usages of every key used."""
+        with self.lock:
+            return Counter(dict((key, sum(len(found) for found in usages.values())) for key, usages in self.keys.items()))
+
+    def unused(self, keys):
+        """Return the sorted keys, of those given, used nowhere."""
+        with self.lock:
+            return sorted(key for key in keys if key not in self.keys)
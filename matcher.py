@@ -0,0 +1,274 @@
+import re
+
+# Keys are only matched when they are not glued to other "word" characters,
+# the same boundary rule the original `(?<![-.\w])...(?![-.\w])` regex used.
+WORD_CHARS = r'[-.\w]'
+
+_word_match = re.compile(WORD_CHARS).match
+_simple_match = re.compile(r'%s+\Z' % WORD_CHARS).match
+
+# Trie node slot holding the key that ends at the node (chars are never empty)
+_END = ''
+
+
+class Matcher(object):
+    """Base class for keyword matching engines."""
+
+    def __init__(self, keys):
+        self.keys = frozenset(key for key in keys if key)
+        self.max_length = max(map(len, self.keys)) if self.keys else 0
+
+    def finditer(self, text, pos=0, endpos=None):
+        """
+        Yield (start, end, key) for every key found in text[pos:endpos].
+
+        Matches are leftmost-longest and never overlap; the characters around
+        pos and endpos are still taken into account for the word boundaries.
+
+        """
+        raise NotImplementedError
+
+    def findall(self, text, pos=0, endpos=None):
+        return list(self.finditer(text, pos, endpos))
+
+
+class TrieMatcher(Matcher):
+    """
+    Prefix trie matcher.
+
+    Candidate starts are located with a single small regex (a boundary
+    followed by the first character of some key), then the trie is walked
+    from there, so the cost per character does not depend on the number of
+    configured keys. When every key is made of word characters only, a match
+    is necessarily a whole word, and a plain dict lookup per word is used.
+
+    """
+
+    def __init__(self, keys):
+        super(TrieMatcher, self).__init__(keys)
+
+        self.simple = all(_simple_match(key) for key in self.keys)
+
+        if self.simple:
+            self.root = None
+            self.start_re = re.compile(r'(?<!%s)%s+' % (WORD_CHARS, WORD_CHARS))
+            return
+
+        root = {}
+        for key in self.keys:
+            node = root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[_END] = key
+        self.root = root
+
+        if root:
+            first = ''.join(re.escape(ch) for ch in sorted(root))
+            self.start_re = re.compile(r'(?<!%s)[%s]' % (WORD_CHARS, first))
+        else:
+            self.start_re = re.compile(r'(?!)')
+
+    def finditer(self, text, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(text)
+
+        if self.simple:
+            keys = self.keys
+            for m in self.start_re.finditer(text, pos, endpos):
+                key = m.group()
+                if key in keys and not _word_match(text, m.end()):
+                    yield m.start(), m.end(), key
+            return
+
+        root = self.root
+        search = self.start_re.search
+
+        m = search(text, pos, endpos)
+        while m:
+            start = j = m.start()
+            node = root
+            found = end = None
+            while j < endpos:
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+                key = node.get(_END)
+                if key is not None and not _word_match(text, j):
+                    found, end = key, j
+
+            if found is not None:
+                yield start, end, found
+                m = search(text, end, endpos)
+            else:
+                m = search(text, start + 1, endpos)
+
+
+class RegexMatcher(Matcher):
+    """The original single alternation regex, kept as a fallback engine."""
+
+    def __init__(self, keys):
+        super(RegexMatcher, self).__init__(keys)
+
+        if self.keys:
+            # Longest keys first, so alternation gives leftmost-longest as well
+            alternation = '|'.join(re.escape(key) for key in sorted(self.keys, key=len, reverse=True))
+            self.regex = r'(?<!%s)(%s)(?!%s)' % (WORD_CHARS, alternation, WORD_CHARS)
+        else:
+            self.regex = r'(?!)'
+        self.re = re.compile(self.regex)
+
+    def finditer(self, text, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(text)
+
+        match = self.re.match
+        for m in self.re.finditer(text, pos, endpos):
+            # The lookahead takes endpos for the end of the text, so a match
+            # ending there may be glued to what follows; try shorter keys then
+            while m is not None and _word_match(text, m.end()):
+                m = match(text, m.start(), m.end() - 1)
+            if m is not None:
+                yield m.start(), m.end(), m.group(1)
+
+
+class FamilyMatcher(Matcher):
+    """
+    Matches the keys of color families besides the keys of base.
+
+    Each family is a single regex factored into a prefix, a color and a
+    shade alternation, so it grows with the number of each rather than with
+    the number of their combinations. A match only counts if one of the
+    families has its color in that shade, looked up as Palette.get() does.
+    The matches of base and of the families are merged leftmost-longest,
+    keys of base winning over identical family keys.
+
+    """
+
+    def __init__(self, base, families):
+        self.base = base
+        self.keys = base.keys
+        self.families = []
+        patterns = []
+        max_length = base.max_length
+        for family in families:
+            if not family.prefixes or not family.colors:
+                continue
+            self.families.append(family)
+            patterns.append(family.pattern)
+            shades = [shade for table in family.colors.values() for shade in table]
+            max_length = max(max_length, (
+                max(map(len, family.prefixes)) + max(map(len, family.colors)) + max(map(len, shades)) +
+                2 * len(family.separator)
+            ))
+        self.max_length = max_length
+
+        if patterns:
+            self.re = re.compile(r'(?<!%s)(?:%s)(?!%s)' % (WORD_CHARS, '|'.join('(?:%s)' % pattern for pattern in patterns), WORD_CHARS))
+        else:
+            self.re = re.compile(r'(?!)')
+
+    def family_matches(self, text, pos, endpos):
+        for m in self.re.finditer(text, pos, endpos):
+            if _word_match(text, m.end()):
+                continue  # glued to the text past endpos
+            # Any family matching here spans the same word, the first one with its color wins
+            key = m.group()
+            if any(family.color(key) is not None for family in self.families):
+                yield m.start(), m.end(), key
+
+    def finditer(self, text, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(text)
+
+        matches = list(self.family_matches(text, pos, endpos))
+        if self.base.keys:
+            # Stable sort, so base matches stay ahead of family matches of the same span
+            matches = sorted(self.base.findall(text, pos, endpos) + matches, key=lambda m: (m[0], -m[1]))
+
+        last = pos
+        for match in matches:
+            if match[0] >= last:
+                yield match
+                last = match[1]
+
+
+MATCHERS = {
+    'trie': TrieMatcher,
+    'regex': RegexMatcher,
+}
+DEFAULT_MATCHER = 'trie'
+
+
+def create_matcher(keys, engine=None, families=()):
+    """Return a matcher for the given keys (and color families) using the named engine."""
+    cls = MATCHERS.get(engine) or MATCHERS[DEFAULT_MATCHER]
+    matcher = cls(keys)
+    if families:
+        matcher = FamilyMatcher(matcher, families)
+    return matcher
+
+
+# Large texts are scanned in chunks of about this many characters
+CHUNK_SIZE = 256 * 1024
+
+_boundary_search = re.compile(r'[^-.\w]').search
+
+
+def chunk_spans(text, chunk_size=CHUNK_SIZE):
+    """Split text in (start, end) spans of about chunk_size, each ending on a non-word character."""
+    spans = []
+    size = len(text)
+    start = 0
+    while start < size:
+        end = start + chunk_size
+        if end < size:
+            m = _boundary_search(text, end)
+            end = m.end() if m else size
+        else:
+            end = size
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+def scan_chunk(job):
+    """Scan one chunk job made by scan_chunks(); a plain function, so it can be sent to a process pool."""
+    matcher, chunk, offset, pos, endpos, keep = job
+    return [(offset + start, offset + end, key) for start, end, key in matcher.finditer(chunk, pos, endpos) if start < keep]
+
+
+def scan_chunks(matcher, text, executor=None, chunk_size=CHUNK_SIZE, check=None):
+    """
+    Return the matches in text as matcher.findall() would, scanning chunks on executor.
+
+    Each chunk is scanned up to the longest key past its end, so matches
+    crossing a chunk boundary are found by the chunk they start in; any
+    overlap between neighbouring chunks is dropped when merging. If given,
+    check() is called before each chunk is merged, and may raise to stop.
+
+    """
+    size = len(text)
+    overlap = matcher.max_length
+    jobs = []
+    for start, end in chunk_spans(text, chunk_size):
+        # One extra character on each side gives the matcher its word boundaries
+        lo = max(start - 1, 0)
+        hi = min(end + overlap + 1, size)
+        jobs.append((matcher, text[lo:hi], lo, start - lo, min(end + overlap, size) - lo, end - lo))
+
+    if executor is not None and len(jobs) > 1:
+        results = executor.map(scan_chunk, jobs)
+    else:
+        results = map(scan_chunk, jobs)
+
+    matches = []
+    last = 0
+    for chunk_matches in results:
+        if check is not None:
+            check()
+        for match in chunk_matches:
+            if match[0] >= last:
+                matches.append(match)
+                last = match[1]
+    return matches
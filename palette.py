@@ -0,0 +1,250 @@
+import re
+import json
+import hashlib
+
+COLOR_RE = re.compile(r'^#[A-F0-9]{8}$')
+
+
+def normalize_color(value):
+    """Return value as '#RRGGBBAA' (accepts #RGB, #RGBA, #RRGGBB), or None if invalid."""
+    try:
+        color = value.upper()
+    except AttributeError:
+        return
+
+    if len(color) == 4: #abc
+        color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + 'FF'
+    elif len(color) == 5: #abcd
+        color = '#' + color[1] * 2 + color[2] * 2 + color[3] * 2 + color[4] * 2
+    elif len(color) == 7: #aabbcc
+        color += 'FF'
+
+    if not COLOR_RE.match(color):
+        return
+
+    if color[7:9] == '00':
+        color = color[:7] + '01'  # alpha == 0 doesn't apply alpha in Sublime
+
+    return color
+
+
+def contrast_color(bg_col, col):
+    """Return a foreground color readable over col blended onto bg_col."""
+    br = int(bg_col[1:3], 16)
+    bg = int(bg_col[3:5], 16)
+    bb = int(bg_col[5:7], 16)
+
+    r = int(col[1:3], 16)
+    g = int(col[3:5], 16)
+    b = int(col[5:7], 16)
+    a = int(col[7:9], 16) / 255.0
+
+    r = br * (1 - a) + r * a
+    g = bg * (1 - a) + g * a
+    b = bb * (1 - a) + b * a
+
+    # L = (max(r, g, b) + min(r, g, b)) / 2
+    # Y709 = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    Y601 = ((r * 299) + (g * 587) + (b * 114)) / 1000
+
+    v = Y601
+
+    if v >= 128:
+        v -= 128
+    else:
+        v += 128
+
+    return '#%sFF' % (('%02X' % int(v)) * 3)
+
+
+def nudge_color(col):
+    """Return col moved one step on each channel, to tell it apart from an identical background."""
+    channels = [int(col[i:i + 2], 16) for i in (1, 3, 5)]
+    channels = [c - 1 if c > 1 else c + 1 for c in channels]
+    return '#%02X%02X%02X%s' % tuple(channels + [col[7:9]])
+
+
+def alternation(items):
+    """Regex alternation of items, longest first so the longest one wins."""
+    return '|'.join(re.escape(item) for item in sorted(items, key=len, reverse=True))
+
+
+class ColorFamily(object):
+    """
+    Keys made of a prefix, a color and a shade, such as Tailwind's
+    bg-sky-500, declared once for all their combinations.
+
+    The combinations are never expanded: a key is parsed back into its
+    parts, and its color looked up by color name and shade.
+
+    """
+
+    def __init__(self, prefixes, colors, separator='-'):
+        self.prefixes = frozenset(prefix for prefix in prefixes if prefix)
+        self.separator = separator
+        self.colors = {}  # color -> {shade: '#RRGGBBAA'}, shade '' for colors without shades
+        self.invalid = {}  # key pattern -> configured value
+
+        for color, shades in colors.items():
+            if not isinstance(shades, dict):
+                shades = {'': shades}
+            table = {}
+            for shade, value in shades.items():
+                normalized = normalize_color(value)
+                if normalized is None:
+                    self.invalid[self.key('*', color, shade)] = value
+                else:
+                    table[str(shade)] = normalized
+            if table:
+                self.colors[color] = table
+
+        shades = set(shade for table in self.colors.values() for shade in table if shade)
+        pattern = '(%s)%s(%s)' % (alternation(self.prefixes) or '(?!)', re.escape(separator), alternation(self.colors) or '(?!)')
+        if shades:
+            pattern += '(?:%s(%s))?' % (re.escape(separator), alternation(shades))
+        self.pattern = pattern  # groups: prefix, color, shade (only if the family has shades)
+        self.parse = re.compile(r'%s\Z' % pattern).match
+
+    def __len__(self):
+        return len(self.prefixes) * sum(len(table) for table in self.colors.values())
+
+    def key(self, prefix, color, shade=''):
+        return self.separator.join([prefix, color, shade] if shade else [prefix, color])
+
+    def color(self, key):
+        """Return the '#RRGGBBAA' color of key, or None if it is not in the family."""
+        m = self.parse(key)
+        if m is None:
+            return None
+        shade = m.group(3) if m.re.groups > 2 else None
+        return self.colors[m.group(2)].get(shade or '')
+
+    def spec(self):
+        return [sorted(self.prefixes), self.separator, sorted((color, sorted(table)) for color, table in self.colors.items())]
+
+
+def layer_colors(layers):
+    """
+    Return the colors and color families of palette layers, later ones winning.
+
+    A layer is a dict with colors and color_families. A color set to null
+    in a layer removes the key, and "inherit": false starts over from the
+    layer instead of adding to the ones below it.
+
+    """
+    colors = {}
+    families = []
+    for layer in layers:
+        if layer.get('inherit') is False:
+            colors = {}
+            families = []
+        for key, value in (layer.get('colors') or {}).items():
+            if value is None:
+                colors.pop(key, None)
+            else:
+                colors[key] = value
+        # Families are looked up in order, put the ones of upper layers first
+        families = list(layer.get('color_families') or ()) + families
+    return colors, families
+
+
+class Palette(object):
+    """
+    The configured colors, normalized once when the settings are loaded.
+
+    Every valid key maps straight to the region (and scope) name of its color,
+    so highlighting a match is a single dict lookup. Keys of color families
+    are resolved by their family instead. Contrast foregrounds and gutter
+    icons are computed at most once per color.
+
+    """
+
+    def __init__(self, colors, prefix='col_', icon_factory=None, families=()):
+        self.prefix = prefix
+        self.icon_factory = icon_factory
+        self.names = {}  # key -> region name
+        self.colors = {}  # region name -> '#RRGGBBAA'
+        self.invalid = {}  # key -> configured value
+        self._foregrounds = {}
+        self._distinct = {}
+        self._icons = {}
+        self._digest = None
+
+        for key, value in colors.items():
+            color = normalize_color(value)
+            if color is None:
+                self.invalid[key] = value
+                continue
+            self.names[key] = self.add(color)
+
+        self.families = []
+        for family in families:
+            family = ColorFamily(family.get('prefixes', ()), family.get('colors', {}), family.get('separator', '-'))
+            self.invalid.update(family.invalid)
+            for table in family.colors.values():
+                for color in table.values():
+                    self.add(color)
+            self.families.append(family)
+
+    def __len__(self):
+        return len(self.names) + sum(len(family) for family in self.families)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def add(self, color):
+        name = self.prefix + color[1:]
+        self.colors[name] = color
+        return name
+
+    def digest(self):
+        """Hash of the keys, all that matchers and what they find depend on."""
+        if self._digest is None:
+            keys = '\n'.join(sorted(self.names))
+            if self.families:
+                keys += json.dumps([family.spec() for family in self.families])
+            self._digest = hashlib.sha1(keys.encode('utf-8')).hexdigest()
+        return self._digest
+
+    def get(self, key, default=None):
+        """Return the region name of key, or default."""
+        name = self.names.get(key)
+        if name is not None:
+            return name
+        for family in self.families:
+            color = family.color(key)
+            if color is not None:
+                return self.prefix + color[1:]
+        return default
+
+    def report(self, log=print, known=()):
+        """Log the invalid colors, except the keys in known (reported before)."""
+        for key, value in sorted(self.invalid.items()):
+            if key in known:
+                continue
+            log("Invalid color for %r: %r" % (key, value))
+
+    def foreground(self, col, bg_col):
+        try:
+            return self._foregrounds[bg_col, col]
+        except KeyError:
+            fg_col = self._foregrounds[bg_col, col] = contrast_color(bg_col, col)
+            return fg_col
+
+    def distinct(self, name, bg_col):
+        """Return name, or the name of a barely different color if it matches the background."""
+        try:
+            return self._distinct[bg_col, name]
+        except KeyError:
+            col = self.colors[name]
+            if col == bg_col:
+                name = self.add(nudge_color(col))
+            self._distinct[bg_col, self.prefix + col[1:]] = name
+            return name
+
+    def icon(self, name, gutter_icon):
+        try:
+            return self._icons[name, gutter_icon]
+        except KeyError:
+            icon = self._icons[name, gutter_icon] = self.icon_factory(name, gutter_icon=gutter_icon)
+            return icon
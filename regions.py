@@ -0,0 +1,350 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Type code of the offset arrays
+OFFSET = 'l'
+
+
+def shift_point(pt, a, b, length):
+    """Return where pt ends up after the text in [a, b) is replaced by length characters."""
+    if pt < a:
+        return pt
+    if pt >= b:
+        return pt + length - (b - a)
+    return a
+
+
+def add_dirty(dirty, a, b, length):
+    """Shift the sorted dirty spans for the edit in [a, b) and merge in the edited text."""
+    delta = length - (b - a)
+    lo, hi = a, a + length
+    merged = []
+    for begin, end in dirty:
+        if end < a:
+            merged.append((begin, end))
+        elif begin > b:
+            merged.append((begin + delta, end + delta))
+        else:
+            lo = min(lo, begin)
+            hi = max(hi, end + delta if end > b else hi)
+    merged.append((lo, hi))
+    merged.sort()
+    return merged
+
+
+def merge_spans(spans):
+    """Return the sorted spans with overlapping or touching ones merged."""
+    merged = []
+    for begin, end in sorted(spans):
+        if merged and begin <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def intersect_spans(spans, others):
+    """Return the parts of the sorted, disjoint spans that are also in the sorted, disjoint others."""
+    result = []
+    i = 0
+    for begin, end in spans:
+        while i < len(others) and others[i][1] <= begin:
+            i += 1
+        j = i
+        while j < len(others) and others[j][0] < end:
+            lo = max(begin, others[j][0])
+            hi = min(end, others[j][1])
+            if lo < hi:
+                result.append((lo, hi))
+            j += 1
+    return result
+
+
+class IntervalSet(object):
+    """A set of points kept as sorted, disjoint [begin, end) intervals."""
+
+    __slots__ = ('begins', 'ends')
+
+    def __init__(self):
+        self.begins = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.begins)
+
+    def __iter__(self):
+        return zip(self.begins, self.ends)
+
+    def clear(self):
+        del self.begins[:]
+        del self.ends[:]
+
+    def add(self, begin, end):
+        if begin >= end:
+            return
+        i = bisect_left(self.ends, begin)
+        j = bisect_right(self.begins, end)
+        if i < j:
+            begin = min(begin, self.begins[i])
+            end = max(end, self.ends[j - 1])
+        self.begins[i:j] = [begin]
+        self.ends[i:j] = [end]
+
+    def remove(self, begin, end):
+        if begin >= end:
+            return
+        i = bisect_right(self.ends, begin)
+        j = bisect_left(self.begins, end)
+        if i >= j:
+            return
+        begins = []
+        ends = []
+        if self.begins[i] < begin:
+            begins.append(self.begins[i])
+            ends.append(begin)
+        if self.ends[j - 1] > end:
+            begins.append(end)
+            ends.append(self.ends[j - 1])
+        self.begins[i:j] = begins
+        self.ends[i:j] = ends
+
+    def missing(self, begin, end):
+        """Return the parts of [begin, end) that are not in the set."""
+        gaps = []
+        i = bisect_right(self.ends, begin)
+        while i < len(self.begins) and self.begins[i] < end:
+            if self.begins[i] > begin:
+                gaps.append((begin, self.begins[i]))
+            begin = max(begin, self.ends[i])
+            i += 1
+        if begin < end:
+            gaps.append((begin, end))
+        return gaps
+
+    def shift(self, a, b, length):
+        """Move the intervals as the text in [a, b) is replaced by length characters."""
+        i = bisect_left(self.ends, a)
+        begins = self.begins[:i]
+        ends = self.ends[:i]
+        for begin, end in zip(self.begins[i:], self.ends[i:]):
+            begin = shift_point(begin, a, b, length)
+            end = shift_point(end, a, b, length)
+            if begin < end:
+                begins.append(begin)
+                ends.append(end)
+        self.begins = begins
+        self.ends = ends
+
+
+# Regions per block of RegionIndex data
+BLOCK_SIZE = 128
+
+
+class Block(object):
+    """
+    A run of consecutive regions of RegionIndex data.
+
+    The offsets are stored less delta, so moving the block along with the
+    text makes a new Block sharing the arrays. Blocks are never mutated,
+    but for the positions of every name, built the first time they are
+    asked for.
+
+    """
+
+    __slots__ = ('begins', 'ends', 'names', 'delta', 'keys', '_positions')
+
+    def __init__(self, begins, ends, names, delta=0, keys=None, positions=None):
+        self.begins = begins
+        self.ends = ends
+        self.names = names
+        self.delta = delta
+        self.keys = frozenset(names) if keys is None else keys
+        self._positions = positions
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        delta = self.delta
+        for begin, end, name in zip(self.begins, self.ends, self.names):
+            yield begin + delta, end + delta, name
+
+    def first(self):
+        return self.begins[0] + self.delta
+
+    def last(self):
+        return self.ends[-1] + self.delta
+
+    def moved(self, delta):
+        return Block(self.begins, self.ends, self.names, self.delta + delta, self.keys, self._positions)
+
+    def positions(self):
+        """Return {name: [index, ...]} of the regions in the block."""
+        if self._positions is None:
+            positions = {}
+            for i, name in enumerate(self.names):
+                positions.setdefault(name, []).append(i)
+            self._positions = positions
+        return self._positions
+
+
+class RegionIndex(object):
+    """
+    The regions highlighted in a view, sorted by offset, as a tuple of Blocks.
+
+    Highlights never overlap, so both begins and ends are sorted and the
+    blocks holding a span are found by their first and last offsets. An
+    edit only rewrites the blocks it falls in and moves the ones after it
+    with a delta. Blocks are replaced rather than mutated, so a scan running
+    on another thread can keep working on the tuple it got from `data` while
+    the index is updated.
+
+    """
+
+    __slots__ = ('data', 'keys')
+
+    def __init__(self):
+        self.data = empty_data()
+        self.keys = set()  # every region name ever added to the view
+
+    def __len__(self):
+        return data_size(self.data)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def clear(self):
+        self.data = empty_data()
+        self.keys = set()
+
+    def shift(self, a, b, length):
+        """Move the regions as the text in [a, b) is replaced by length characters."""
+        if b - a == length:
+            return
+        delta = length - (b - a)
+        blocks = []
+        for block in self.data:
+            if block.last() < a:
+                blocks.append(block)
+            elif block.first() >= b:
+                blocks.append(block.moved(delta))
+            else:
+                begins = array(OFFSET)
+                ends = array(OFFSET)
+                for begin, end, _ in block:
+                    begins.append(begin if begin < a else begin + delta if begin >= b else a)
+                    ends.append(end if end < a else end + delta if end >= b else a)
+                blocks.append(Block(begins, ends, block.names, 0, block.keys, block._positions))
+        self.data = tuple(blocks)
+
+
+def empty_data():
+    return ()
+
+
+def data_size(data):
+    """Return the number of regions in RegionIndex data."""
+    return sum(len(block) for block in data)
+
+
+def make_blocks(matches):
+    """Return the sorted (begin, end, name) matches cut into Blocks."""
+    blocks = []
+    for i in range(0, len(matches), BLOCK_SIZE):
+        begins, ends, names = zip(*matches[i:i + BLOCK_SIZE])
+        blocks.append(Block(array(OFFSET, begins), array(OFFSET, ends), list(names)))
+    return blocks
+
+
+def index_data(matches):
+    """Return RegionIndex data for the (begin, end, name) matches, which must be sorted."""
+    return tuple(make_blocks(matches))
+
+
+def replace_within(data, spans, matches):
+    """
+    Return new RegionIndex data and the names affected.
+
+    The regions lying inside any of the sorted, disjoint spans are dropped
+    and the sorted (begin, end, name) matches found in those spans are added.
+    Only the blocks the spans fall in (or next to) are rewritten. A name
+    is affected only if its regions changed, those found again where they
+    were are already in the view.
+
+    """
+    if not data:
+        return index_data(matches), set(name for _, _, name in matches)
+
+    firsts = [block.first() for block in data]
+    lasts = [block.last() for block in data]
+    touched = set()
+    for begin, end in spans:
+        i = bisect_left(lasts, begin)
+        j = bisect_right(firsts, end)
+        if i < j:
+            touched.update(range(i, j))
+        else:
+            touched.add(min(i, len(data) - 1))  # in a gap, the matches go with the next block
+
+    dropped = []
+    blocks = []
+    pos = 0
+    m = 0
+    span = 0
+    for i in sorted(touched):
+        if i < pos:
+            continue
+        j = i + 1
+        while j in touched:
+            j += 1
+        blocks.extend(data[pos:i])
+        pos = j
+
+        # Everything between the blocks before and after the run belongs to it
+        limit = firsts[j] if j < len(data) else float('inf')
+        regions = []
+        for block in data[i:j]:
+            for region in block:
+                begin, end, name = region
+                while span < len(spans) and spans[span][1] < end:
+                    span += 1
+                if span < len(spans) and spans[span][0] <= begin:
+                    dropped.append(region)
+                else:
+                    regions.append(region)
+        while m < len(matches) and matches[m][0] < limit:
+            regions.append(matches[m])
+            m += 1
+        regions.sort()
+        blocks.extend(make_blocks(regions))
+    blocks.extend(data[pos:])
+
+    affected = set(name for _, _, name in set(dropped).symmetric_difference(matches))
+    return tuple(blocks), affected
+
+
+def group_by_name(data, wanted=None):
+    """Return {name: [(begin, end), ...]} for the names in wanted (or all of them)."""
+    groups = {}
+    if wanted is None:
+        for block in data:
+            delta = block.delta
+            spans = zip(block.begins, block.ends)
+            if delta:
+                spans = ((begin + delta, end + delta) for begin, end in spans)
+            for span, name in zip(spans, block.names):
+                groups.setdefault(name, []).append(span)
+        return groups
+
+    for name in wanted:
+        groups[name] = []
+    for block in data:
+        names = block.keys.intersection(wanted)
+        if not names:
+            continue
+        begins, ends, delta = block.begins, block.ends, block.delta
+        positions = block.positions()
+        for name in names:
+            groups[name].extend((begins[i] + delta, ends[i] + delta) for i in positions[name])
+    return groups
@@ -0,0 +1,154 @@
+import time
+import threading
+import itertools
+
+# Job priorities, lower runs first
+ACTIVE = 0  # the view being edited
+VISIBLE = 1  # views shown in some group
+BACKGROUND = 2  # other tabs
+
+# A slice of work runs at least this many seconds before it checks whether to yield
+SLICE_BUDGET = 0.02
+
+# A cancellation token asks whether its work is stale at most once per this many seconds
+CANCEL_INTERVAL = 0.005
+
+
+class Preempted(Exception):
+    """Raised by TimeSlice.check() to put a job back in favour of a more urgent one."""
+
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check() once the work it guards is stale."""
+
+
+class Job(object):
+    __slots__ = ('key', 'priority', 'seq', 'callback')
+
+    def __init__(self, key, priority, seq, callback):
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.callback = callback
+
+
+class Scheduler(object):
+    """
+    Jobs keyed by view, run by priority, then in the order they were queued.
+
+    Queuing a job for a key replaces the one already waiting for it, so each
+    view has at most one pending job.
+
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.jobs
+
+    def push(self, key, priority, callback, replace=True, seq=None):
+        """
+        Queue callback under key (None for a job of its own).
+
+        Returns False, queuing nothing, if replace is false and key already has a job.
+        A job put back passes the seq it had, to keep its place.
+
+        """
+        with self.lock:
+            if not replace and key in self.jobs:
+                return False
+            if seq is None:
+                seq = next(self.counter)
+            if key is None:
+                key = seq
+            self.jobs[key] = Job(key, priority, seq, callback)
+            return True
+
+    def mark(self):
+        """Return a seq above those of all the jobs queued so far, for pop()."""
+        with self.lock:
+            return next(self.counter)
+
+    def pop(self, before=None):
+        """Return the most urgent job, of those queued before the seq before if given, or None."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if before is None or job.seq < before]
+            if not jobs:
+                return None
+            job = min(jobs, key=lambda job: (job.priority, job.seq))
+            del self.jobs[job.key]
+            return job
+
+    def waiting(self, priority):
+        """Whether a job more urgent than priority is queued."""
+        with self.lock:
+            return any(job.priority < priority for job in self.jobs.values())
+
+    def discard(self, key):
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.jobs.clear()
+
+
+class TimeSlice(object):
+    """
+    Handed to a running job, which calls check() between units of work.
+
+    Once the job has run for the budget, check() gives other threads a
+    chance to run, and raises Preempted if a more urgent job is queued.
+
+    """
+
+    def __init__(self, scheduler, priority, budget=SLICE_BUDGET):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.budget = budget
+        self.start = time.time()
+
+    def check(self):
+        now = time.time()
+        if now - self.start < self.budget:
+            return
+        if self.scheduler.waiting(self.priority):
+            raise Preempted()
+        time.sleep(0)  # yield, the main thread may be waiting for the GIL
+        self.start = time.time()
+
+
+class CancelToken(object):
+    """
+    Tells a running job whether what it works on changed since it started.
+
+    generation() is called to get the current generation of the input (the
+    change count of a view); the token is cancelled once it differs from the
+    one the job started with.
+
+    """
+
+    __slots__ = ('generation', 'expected', 'checked')
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.expected = generation()
+        self.checked = time.time()
+
+    def cancelled(self):
+        return self.generation() != self.expected
+
+    def check(self):
+        now = time.time()
+        if now - self.checked < CANCEL_INTERVAL:
+            return
+        self.checked = now
+        if self.cancelled():
+            raise Cancelled()
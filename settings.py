@@ -83,6 +83,24 @@ class Settings(object):
             "gutter_icon": settings.get("gutter_icon"),
             "highlight_values": settings.get("highlight_values"),
             "colors": settings.get("colors"),
+            "color_families": settings.get("color_families"),
+            "syntaxes": settings.get("syntaxes"),
+            "matcher_cache_size": settings.get("matcher_cache_size"),
+            "matcher": settings.get("matcher"),
+            "scopes": settings.get("scopes"),
+            "incremental": settings.get("incremental"),
+            "large_files": settings.get("large_files"),
+            "lazy_highlight": settings.get("lazy_highlight"),
+            "viewport_margin": settings.get("viewport_margin"),
+            "icon_cache_max_files": settings.get("icon_cache_max_files"),
+            "icon_cache_max_size": settings.get("icon_cache_max_size"),
+            "match_cache": settings.get("match_cache"),
+            "match_cache_max_files": settings.get("match_cache_max_files"),
+            "match_cache_max_size": settings.get("match_cache_max_size"),
+            "preseed_color_scheme": settings.get("preseed_color_scheme"),
+            "delay": settings.get("delay"),
+            "busy_share": settings.get("busy_share"),
+            "log_debounce": settings.get("log_debounce"),
         }
 
         # print(self.settings)
@@ -0,0 +1,85 @@
+from .stats import Rolling, Profile
+from .regions import RegionIndex
+
+
+class ViewState(object):
+    """What the highlighter keeps about one view."""
+
+    __slots__ = (
+        'view_id',
+        'buffer_id',
+        'scan_time',  # how long the last full highlight took (ms), None before the first one
+        'highlights',  # RegionIndex of the highlighted regions
+        'change_count',  # change count of the view when its highlights were last applied
+        'coverage',  # IntervalSet of the text already scanned (lazy highlighting only)
+        'dirty',  # spans edited since the last highlight
+        'viewport_pending',  # when a viewport fill was queued
+        'latency',  # Rolling time (ms) passes took, scan to apply
+        'cadence',  # Rolling time (ms) between edits while typing
+        'last_edit',  # when the view was last edited
+        'decision',  # the last debounce Decision made for the view
+        'profile',  # Profile of the phases of the passes over the view
+        'palette',  # (settings_changes, (Palette, matcher)) of the view, see view_palette()
+        'settings_changes',  # how many times the settings of the view changed
+    )
+
+    def __init__(self, view_id, buffer_id):
+        self.view_id = view_id
+        self.buffer_id = buffer_id
+        self.scan_time = None
+        self.highlights = RegionIndex()
+        self.change_count = None
+        self.coverage = None
+        self.dirty = None
+        self.viewport_pending = 0
+        self.latency = Rolling()
+        self.cadence = Rolling()
+        self.last_edit = 0
+        self.decision = None
+        self.profile = Profile()
+        self.palette = None
+        self.settings_changes = 0
+
+
+class ViewRegistry(object):
+    """The ViewState of every view seen so far, by view id and by buffer id."""
+
+    def __init__(self):
+        self.views = {}
+        self.buffers = {}
+
+    def __len__(self):
+        return len(self.views)
+
+    def __iter__(self):
+        return iter(list(self.views.values()))
+
+    def __contains__(self, view_id):
+        return view_id in self.views
+
+    def get(self, view_id):
+        return self.views.get(view_id)
+
+    def state(self, view):
+        """Return the state of view, creating it the first time."""
+        state = self.views.get(view.id())
+        if state is None:
+            state = self.views[view.id()] = ViewState(view.id(), view.buffer_id())
+            self.buffers.setdefault(state.buffer_id, []).append(state)
+        return state
+
+    def for_buffer(self, buffer_id):
+        return self.buffers.get(buffer_id, ())
+
+    def discard(self, view_id):
+        state = self.views.pop(view_id, None)
+        if state is not None:
+            states = self.buffers[state.buffer_id]
+            states.remove(state)
+            if not states:
+                del self.buffers[state.buffer_id]
+        return state
+
+    def clear(self):
+        self.views.clear()
+        self.buffers.clear()
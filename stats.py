@@ -0,0 +1,114 @@
+import time
+from collections import Counter
+
+
+class Rolling(object):
+    """
+    The last `size` samples of a series, plus an EWMA of all of them.
+
+    Percentiles are taken over the window, so they follow recent behaviour
+    while the EWMA smooths out single outliers.
+
+    """
+
+    __slots__ = ('samples', 'size', 'pos', 'count', 'alpha', 'ewma')
+
+    def __init__(self, size=64, alpha=0.2):
+        self.samples = []
+        self.size = size
+        self.pos = 0
+        self.count = 0  # samples ever added
+        self.alpha = alpha
+        self.ewma = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value):
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.pos] = value
+            self.pos = (self.pos + 1) % self.size
+        self.count += 1
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+    def percentile(self, p):
+        """Nearest-rank p-th percentile (0-100) of the window, None if empty."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        rank = int(round(p / 100.0 * (len(ordered) - 1)))
+        return ordered[rank]
+
+    def max(self):
+        return max(self.samples) if self.samples else None
+
+
+class Probe(object):
+    """
+    Times the phases of one highlight pass.
+
+    lap(phase) charges the time since the previous lap to phase, so the
+    phases of a pass are timed with one clock read each.
+
+    """
+
+    __slots__ = ('times', 'counts', 'keys', 'last')
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.keys = None  # {key: matches} of the pass
+        self.last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.times[phase] = self.times.get(phase, 0) + (now - self.last) * 1000
+        self.last = now
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class Profile(object):
+    """Rolling per-phase timings (ms) and counts of the passes over one view, and its most matched keys."""
+
+    __slots__ = ('passes', 'phases', 'counts', 'keys')
+
+    def __init__(self):
+        self.passes = 0
+        self.phases = {}
+        self.counts = {}
+        self.keys = Counter()
+
+    def record(self, probe):
+        self.passes += 1
+        for phase, ms in probe.times.items():
+            series = self.phases.get(phase)
+            if series is None:
+                series = self.phases[phase] = Rolling()
+            series.add(ms)
+        for name, value in probe.counts.items():
+            series = self.counts.get(name)
+            if series is None:
+                series = self.counts[name] = Rolling()
+            series.add(value)
+        if probe.keys:
+            self.keys.update(probe.keys)
+
+    def summary(self, hottest=10):
+        """The profile as a dict, with p50/p95/max of every series."""
+        def describe(series):
+            return dict((name, {
+                'p50': rolling.percentile(50),
+                'p95': rolling.percentile(95),
+                'max': rolling.max(),
+            }) for name, rolling in series.items())
+
+        return {
+            'passes': self.passes,
+            'phases': describe(self.phases),
+            'counts': describe(self.counts),
+            'hottest': self.keys.most_common(hottest),
+        }